@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+# Local state shared by the Cloudant tools in this directory
+# Everything lives under ~/.cloudant_tools. Per-database stats are kept in a SQLite
+# file so repeat runs only need to ask Cloudant about databases whose entry has expired.
+# Node disk usage history is kept in a second SQLite file for cluster_disk.py --trend.
+
+import os, time, json, sqlite3, threading
+
+def state_path(filename):
+    # Returns the path of a file in the state directory, creating the directory if needed
+    state_dir = os.path.join(os.path.expanduser('~'), '.cloudant_tools')
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return os.path.join(state_dir, filename)
+
+class StatsCache(object):
+    # Last known stats of each database, keyed by account and database name.
+    # Stats carry the time they were fetched so callers can apply a TTL. The shard
+    # count (Q) and replica count (N) of a database never change, so they never expire.
+    # Safe to share between threads; writes are committed in batches.
+
+    def __init__(self, path=None, commit_every=500):
+        if path is None:
+            path = state_path('stats.sqlite')
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.pending = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS dbstats (
+                account TEXT NOT NULL,
+                db TEXT NOT NULL,
+                doc_count INTEGER,
+                del_doc_count INTEGER,
+                active INTEGER,
+                disk INTEGER,
+                update_seq TEXT,
+                stats_at REAL,
+                shardcount INTEGER,
+                nvalue INTEGER,
+                PRIMARY KEY (account, db)
+            )""")
+        # Shard placement: the number of shard ranges (Q) and how many shard copies each node holds
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS placements (
+                account TEXT NOT NULL,
+                db TEXT NOT NULL,
+                q INTEGER,
+                nodes TEXT,
+                placed_at REAL,
+                PRIMARY KEY (account, db)
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS feeds (
+                account TEXT NOT NULL,
+                feed TEXT NOT NULL,
+                since TEXT,
+                PRIMARY KEY (account, feed)
+            )""")
+        self.conn.commit()
+
+    def get(self, account, db):
+        # Returns the entry as a dict, or None if the database has never been seen
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM dbstats WHERE account = ? AND db = ?",
+                (account, db)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(row.keys(), row))
+
+    def put_stats(self, account, db, doc_count, del_doc_count, active, disk, update_seq):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO dbstats (account, db) VALUES (?, ?)",
+                (account, db)
+            )
+            self.conn.execute(
+                """UPDATE dbstats SET doc_count = ?, del_doc_count = ?, active = ?, disk = ?,
+                   update_seq = ?, stats_at = ? WHERE account = ? AND db = ?""",
+                (doc_count, del_doc_count, active, disk, update_seq, time.time(), account, db)
+            )
+            self.written()
+
+    def put_shards(self, account, db, shardcount, nvalue):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO dbstats (account, db) VALUES (?, ?)",
+                (account, db)
+            )
+            self.conn.execute(
+                "UPDATE dbstats SET shardcount = ?, nvalue = ? WHERE account = ? AND db = ?",
+                (shardcount, nvalue, account, db)
+            )
+            self.written()
+
+    def get_placement(self, account, db):
+        # Returns (q, {node: shard copies}, placed_at), or None if the database was never mapped
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT q, nodes, placed_at FROM placements WHERE account = ? AND db = ?",
+                (account, db)
+            ).fetchone()
+        if row is None:
+            return None
+        nodes = dict((int(node), copies) for node, copies in json.loads(row[1]).iteritems())
+        return row[0], nodes, row[2]
+
+    def put_placement(self, account, db, q, nodes):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO placements (account, db, q, nodes, placed_at) VALUES (?, ?, ?, ?, ?)",
+                (account, db, q, json.dumps(nodes), time.time())
+            )
+            self.written()
+
+    def totals(self, account):
+        # Returns the database count and summed doc count, deleted doc count, active
+        # size and disk size of every cached database in the account
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT COUNT(*), COALESCE(SUM(doc_count), 0), COALESCE(SUM(del_doc_count), 0),
+                   COALESCE(SUM(active), 0), COALESCE(SUM(disk), 0) FROM dbstats WHERE account = ?""",
+                (account,)
+            ).fetchone()
+        return tuple(row)
+
+    def get_since(self, account, feed):
+        # Returns the saved position in a feed (e.g. _db_updates), or None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT since FROM feeds WHERE account = ? AND feed = ?",
+                (account, feed)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_since(self, account, feed, since):
+        # Commits immediately, along with any stats written before it
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO feeds (account, feed, since) VALUES (?, ?, ?)",
+                (account, feed, since)
+            )
+            self.conn.commit()
+            self.pending = 0
+
+    def clear(self, account):
+        # Forgets every database in the account
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM dbstats WHERE account = ?",
+                (account,)
+            )
+            self.written()
+
+    def delete(self, account, db):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM dbstats WHERE account = ? AND db = ?",
+                (account, db)
+            )
+            self.conn.execute(
+                "DELETE FROM placements WHERE account = ? AND db = ?",
+                (account, db)
+            )
+            self.written()
+
+    def written(self):
+        # Caller must hold the lock
+        self.pending = self.pending + 1
+        if self.pending >= self.commit_every:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class DiskHistory(object):
+    # Used and free disk space of each cluster node over time, appended to by every
+    # cluster_disk.py run so trends can be reported without asking the monitoring API.
+
+    def __init__(self, path=None):
+        if path is None:
+            path = state_path('disk_history.sqlite')
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS disk_samples (
+                cluster TEXT NOT NULL,
+                node INTEGER NOT NULL,
+                at INTEGER NOT NULL,
+                used REAL,
+                free REAL,
+                PRIMARY KEY (cluster, node, at)
+            )""")
+        # Accounts and cluster names given on the command line, to the cluster they're on
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cluster_names (
+                name TEXT PRIMARY KEY,
+                cluster TEXT NOT NULL
+            )""")
+        self.conn.commit()
+
+    def add(self, cluster, samples):
+        # samples are (node, time, used, free)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO disk_samples (cluster, node, at, used, free) VALUES (?, ?, ?, ?, ?)",
+            ((cluster, node, int(at), used, free) for node, at, used, free in samples)
+        )
+        self.conn.commit()
+
+    def add_name(self, name, cluster):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cluster_names (name, cluster) VALUES (?, ?)",
+            (name, cluster)
+        )
+        self.conn.commit()
+
+    def resolve(self, name):
+        # Returns the cluster a name was last seen on, or the name itself
+        row = self.conn.execute(
+            "SELECT cluster FROM cluster_names WHERE name = ?",
+            (name,)
+        ).fetchone()
+        if row is None:
+            return name
+        return row[0]
+
+    def samples(self, cluster, since):
+        # Returns (node, time, used, free) for every sample since 'since', by node and time
+        return self.conn.execute(
+            "SELECT node, at, used, free FROM disk_samples WHERE cluster = ? AND at >= ? ORDER BY node, at",
+            (cluster, int(since))
+        ).fetchall()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Shared HTTP layer for the Cloudant tools in this directory
+# Keeps one pooled requests session per process, so connections (and their TLS handshakes)
+# are reused for every request to the same host instead of being opened per request.
+# Rate limited (429) and failed (5xx, connection reset) requests are retried with jittered
+# exponential backoff. Writes (POST, DELETE) may have been applied before they failed, so
+# they are only retried when rejected with 429 or when they never reached the server.
+# Every thread in the process shares one adaptive limit on the number of requests in
+# flight, which is halved whenever Cloudant pushes back.
+
+# Optional environment variables:
+# CLOUDANT_POOL_SIZE=<n> (Connections kept open per host, and most requests in flight, default 10)
+# CLOUDANT_MAX_RETRIES=<n> (Times a throttled or failed request is retried, default 6)
+
+import os, threading, time, random
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+config = dict(
+    pool_size = int(os.environ.get('CLOUDANT_POOL_SIZE', 10)),
+    pool_hosts = 10, # Number of hosts that each keep their own connection pool
+    max_retries = int(os.environ.get('CLOUDANT_MAX_RETRIES', 6)),
+    backoff_base = 0.5, # Seconds, doubled on each retry
+    backoff_max = 60, # Longest wait between retries (seconds)
+    retry_statuses = (429, 500, 502, 503, 504),
+    idempotent_methods = ('GET', 'HEAD'), # Safe to retry whatever the failure
+    session = None,
+    limiter = None,
+    pid = None
+)
+session_lock = threading.Lock()
+
+class ConcurrencyLimiter(object):
+    # Limits requests in flight. The limit grows by one for every 'limit' successful
+    # requests and halves when one is throttled or fails (additive increase,
+    # multiplicative decrease), so parallel workers settle just under the rate
+    # the account allows. A burst of throttled requests that were all in flight
+    # together only halves the limit once: requests started before the last cut
+    # don't cut it again.
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.started = 0 # Requests started so far, numbering each one
+        self.cut_at = 0 # Value of started when the limit was last halved
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        # Returns the request's number, to be passed back to release()
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight = self.in_flight + 1
+            self.started = self.started + 1
+            return self.started
+
+    def release(self, ticket, throttled):
+        # throttled is None for a request that says nothing about load either way
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            if throttled:
+                if ticket > self.cut_at:
+                    self.limit = max(self.limit / 2, 1.0)
+                    self.cut_at = self.started
+            elif throttled is not None:
+                self.limit = min(self.limit + (1 / self.limit), self.max_limit)
+            self.condition.notify_all()
+
+def configure(pool_size):
+    # Sets the number of connections kept open per host. Takes effect on the next request.
+    with session_lock:
+        config['pool_size'] = max(pool_size, 1)
+        config['session'] = None
+
+def get_session():
+    # Sessions are per-process. A worker forked by multiprocessing must not share its
+    # parent's sockets, so it builds its own session on first use.
+    with session_lock:
+        if config['session'] is None or config['pid'] != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections = config['pool_hosts'],
+                pool_maxsize = config['pool_size']
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            config['session'] = session
+            config['limiter'] = ConcurrencyLimiter(config['pool_size'])
+            config['pid'] = os.getpid()
+        return config['session']
+
+def get_limiter():
+    get_session()
+    return config['limiter']
+
+def retry_delay(response, attempt):
+    # Full jitter: a random wait up to the exponential backoff ceiling, so workers that
+    # were throttled together don't all retry together. Retry-After is a lower bound.
+    ceiling = min(config['backoff_base'] * (2 ** attempt), config['backoff_max'])
+    delay = random.uniform(0, ceiling)
+    if response is not None and 'Retry-After' in response.headers:
+        try:
+            delay = delay + float(response.headers['Retry-After'])
+        except ValueError:
+            # HTTP-date form, fall back to the backoff ceiling
+            delay = ceiling
+    return delay
+
+def not_sent(error):
+    # True if a connection error happened before the request reached the server
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def should_retry(method, response, error):
+    if error is not None:
+        return method in config['idempotent_methods'] or not_sent(error)
+    if response.status_code not in config['retry_statuses']:
+        return False
+    return method in config['idempotent_methods'] or response.status_code == 429
+
+def request(method, url, **kwargs):
+    # Returns the final response, whatever its status. Raises the last connection error
+    # if every attempt failed to connect.
+    retries = kwargs.pop('retries', config['max_retries'])
+    attempt = 0
+    while True:
+        session = get_session()
+        limiter = get_limiter()
+        ticket = limiter.acquire()
+        response = None
+        error = None
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            if response is not None:
+                throttled = response.status_code in config['retry_statuses']
+            elif retries == 0 and isinstance(error, requests.Timeout):
+                # A caller that allows no retries sets its own short timeout (e.g.
+                # cluster_disk.py's stale node check), so this says nothing about load
+                throttled = None
+            else:
+                throttled = True
+            limiter.release(ticket, throttled)
+        if attempt >= retries or not should_retry(method.upper(), response, error):
+            if error is not None:
+                raise error
+            return response
+        time.sleep(retry_delay(response, attempt))
+        attempt = attempt + 1
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Shared output layer for the Cloudant reporting tools in this directory
+# Tools hand every record they produce to an Output, which streams it to each requested sink
+# as it arrives. Several sinks can be fed from one collection pass, e.g.
+#   --format table --format jsonl:dbs.jsonl --format prom:dbs.prom
+# Formats:
+#   table  The tool's usual human-readable output (default, terminal only)
+#   jsonl  One JSON object per line, with the record kind in "kind"
+#   csv    Comma separated, with a header row each time a new record kind starts
+#   prom   Prometheus text exposition format, written when the tool finishes
+
+import sys, json, csv, re
+from StringIO import StringIO
+from collections import OrderedDict
+
+formats = ('table', 'jsonl', 'csv', 'prom')
+
+def add_argument(argparser):
+    argparser.add_argument(
+        '--format',
+        action = 'append',
+        metavar = 'FORMAT[:FILE]',
+        help = 'Output format, one of {0} (default: table). Repeat to write several at once. '
+            'Machine-readable formats go to FILE if given, otherwise to stdout'.format(', '.join(formats))
+    )
+
+class JsonLinesSink(object):
+    def __init__(self, stream, tool):
+        self.stream = stream
+
+    def write(self, kind, record):
+        line = OrderedDict([('kind', kind)])
+        line.update(record)
+        self.stream.write(json.dumps(line) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+class CsvSink(object):
+    def __init__(self, stream, tool):
+        self.stream = stream
+        self.writer = csv.writer(stream)
+        self.header = None
+
+    def write(self, kind, record):
+        # A new header row starts each run of records with the same kind and fields
+        header = ['kind'] + list(record.keys())
+        if header != self.header:
+            self.writer.writerow(header)
+            self.header = header
+        row = [kind]
+        for value in record.values():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        self.writer.writerow(row)
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+class PrometheusSink(object):
+    # Prometheus needs every sample of a metric grouped together, so samples are
+    # collected and written out in close()
+
+    def __init__(self, stream, tool):
+        self.stream = stream
+        self.prefix = 'cloudant_' + tool
+        self.metrics = OrderedDict()
+
+    def write(self, kind, record):
+        labels = []
+        values = []
+        for key, value in record.items():
+            if value is None:
+                continue
+            elif isinstance(value, bool):
+                values.append((key, int(value)))
+            elif isinstance(value, (int, long, float)):
+                values.append((key, value))
+            else:
+                labels.append('{0}="{1}"'.format(key, self.escape(value)))
+        for key, value in values:
+            name = re.sub('[^a-zA-Z0-9_]', '_', '{0}_{1}_{2}'.format(self.prefix, kind, key))
+            self.metrics.setdefault(name, []).append((','.join(labels), value))
+
+    def escape(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def close(self):
+        for name, samples in self.metrics.items():
+            self.stream.write('# TYPE {0} gauge\n'.format(name))
+            for labels, value in samples:
+                if isinstance(value, float):
+                    # str() rounds to 12 digits, which loses precision on timestamps
+                    value = repr(value)
+                if labels:
+                    self.stream.write('{0}{{{1}}} {2}\n'.format(name, labels, value))
+                else:
+                    self.stream.write('{0} {1}\n'.format(name, value))
+        self.stream.flush()
+
+sinks = dict(
+    jsonl = JsonLinesSink,
+    csv = CsvSink,
+    prom = PrometheusSink
+)
+
+class Output(object):
+    # 'table' is True when the tool should print its usual tables. Only one format may
+    # write to stdout, and not alongside table.
+
+    def __init__(self, specs, tool):
+        self.table = False
+        self.sinks = []
+        self.files = []
+        stdout_used = False
+        for spec in specs or ['table']:
+            fmt, sep, path = spec.partition(':')
+            if fmt not in formats:
+                sys.exit("ERROR: Unknown output format \"{0}\", use one of: {1}".format(fmt, ', '.join(formats)))
+            if fmt == 'table':
+                if path:
+                    sys.exit("ERROR: table output can only go to the terminal")
+                self.table = True
+                continue
+            if path:
+                stream = open(path, 'w')
+                self.files.append(stream)
+            elif stdout_used:
+                sys.exit("ERROR: Only one output format can write to stdout, give the others a FILE")
+            else:
+                stream = sys.stdout
+                stdout_used = True
+            self.sinks.append(sinks[fmt](stream, tool))
+        if self.table and stdout_used:
+            sys.exit("ERROR: table output already uses stdout, give {0} a FILE".format(
+                ', '.join(spec for spec in specs if ':' not in spec and spec != 'table')
+            ))
+
+    def emit(self, kind, record):
+        # record is an OrderedDict of field name to value
+        for sink in self.sinks:
+            sink.write(kind, record)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        for stream in self.files:
+            stream.close()
+
+class BufferOutput(Output):
+    # Renders records to Prometheus text in memory instead of to a file, for exporter.py
+
+    def __init__(self, tool):
+        self.table = False
+        self.stream = StringIO()
+        self.sinks = [PrometheusSink(self.stream, tool)]
+        self.files = []
+
+    def getvalue(self):
+        self.close()
+        return self.stream.getvalue()
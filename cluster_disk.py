@@ -2,22 +2,41 @@
 # Fast and dirty script to grab -u username -c cluster disk space per node and print it out
 # Set your environment variable "CLOUDANT_ADMIN_AUTH" to an auth string (i.e. "Basic: <base64auth>")
 
-import requests
+import cloudant_client
 import json
 import re
 import sys
 import getopt
 import numpy
 import os
-from multiprocessing import Pool
+import time
+from multiprocessing.pool import ThreadPool
 import argparse
+import cloudant_output
+import cloudant_cache
+import userdbs
+import heapq
+from collections import OrderedDict
 
 authstring = os.environ.get('CLOUDANT_ADMIN_AUTH')
 my_header = {'Content-Type': 'application/json', 'Authorization': authstring}
 config = dict(
-    cluster = ''
+    cluster = '',
+    output = None,
+    pool = None,
+    pool_size = 0,
+    max_requests = 96, # Most monitoring requests in flight at once
+    window = None, # Seconds of history to fetch, None for the endpoint's default
+    resolution = None, # Seconds per downsampled bucket
+    slice_seconds = 6 * 3600, # Longest time range fetched by one request
+    placement_ttl = 7 * 86400, # Seconds before a cached shard map is fetched again (shards move on rebalancing)
+    account = ''
 )
 results = dict()
+stale = dict() # Reason each node without a result is missing, by node number
+# Downsampled series of each node fetched with --window: bucket times, then used and free
+# min/max/mean arrays
+history = dict()
 
 # Main
 def main(argv):
@@ -29,38 +48,244 @@ def main(argv):
         )
     argparser.add_argument(
         '-t',
-        help = 'Time to wait for all nodes to return disk status',
+        help = 'Time to wait for each monitoring request. Nodes that don\'t answer in time are reported as stale',
         type=int,
         nargs = '?',
         default = 30,
         metavar = 'seconds'
     )
+    argparser.add_argument(
+        '--window',
+        help = 'How much disk history to fetch, e.g. 6h or 7d (default: the monitoring API\'s last few minutes)',
+        type = parse_duration,
+        metavar = 'DURATION'
+    )
+    argparser.add_argument(
+        '--resolution',
+        help = 'Bucket size the --window history is downsampled to, e.g. 5m (default: about 500 buckets)',
+        type = parse_duration,
+        metavar = 'DURATION'
+    )
+    argparser.add_argument(
+        '--attribute',
+        help = 'Estimate how much of each node\'s disk every database in the account uses, from its shard map and file size, and rank the databases on the fullest node',
+        action = 'store_true'
+    )
+    argparser.add_argument(
+        '--node',
+        help = 'With --attribute, rank the databases on this node (e.g. db12) instead of the fullest one. Can be repeated',
+        action = 'append',
+        metavar = 'NODE'
+    )
+    argparser.add_argument(
+        '--top',
+        help = 'Number of databases ranked per node with --attribute (default: 20)',
+        type = int,
+        default = 20,
+        metavar = 'N'
+    )
+    argparser.add_argument(
+        '--trend',
+        help = 'Report growth, skew and time to 90%% full from the history saved by earlier runs over the last DAYS (default: 30), without querying the cluster',
+        type = int,
+        nargs = '?',
+        const = 30,
+        metavar = 'DAYS'
+    )
+    cloudant_output.add_argument(argparser)
     myargs = argparser.parse_args()
+    config['output'] = cloudant_output.Output(myargs.format, 'cluster_disk')
+    if myargs.resolution and not myargs.window:
+        sys.exit("ERROR: --resolution needs --window")
+    if myargs.window:
+        config['window'] = myargs.window
+        config['resolution'] = myargs.resolution or max(myargs.window / 500, 60)
     
+    if myargs.trend:
+        print_trend(myargs.name, myargs.trend)
+        config['output'].close()
+        return
+
     nodes = get_node_list(myargs.name)
 
-    p = Pool()
-    # Changed to map_async and added a 30-second timeout value. 
-    try:
-        results_array = p.map_async(get_disk_state_of_node, nodes).get(myargs.t)
-    except Exception as e:
-        sys.exit("Timeout. Increase wait time beyond {0} seconds or check cluster status: {1}".format(myargs.t, e))
-    
-    for node_data in results_array:
-        results[node_data[0]] = [
-            node_data[1],
-            node_data[2],
-            node_data[3],
-            node_data[4],
-            node_data[5]
-        ]
+    get_disk_states(nodes, myargs.t)
+    save_history(myargs.name)
+
+    if myargs.attribute:
+        print_attribution(myargs.name, myargs.node, myargs.top)
+        config['output'].close()
+        return
         
     print_results()
+    config['output'].close()
+
+def parse_duration(text):
+    # '90', '90s', '15m', '6h', '7d' or '2w' to seconds
+    m = re.match('^([0-9]+)([smhdw]?)$', text)
+    if not m:
+        raise argparse.ArgumentTypeError("expected a duration like 30m, 6h or 7d, not \"{0}\"".format(text))
+    units = dict(s = 1, m = 60, h = 3600, d = 86400, w = 604800)
+    return int(m.group(1)) * units[m.group(2) or 's']
+
+def time_slices():
+    # (start, end) of each request's share of the --window, or the endpoint's default range
+    if config['window'] is None:
+        return [(None, None)]
+    end = int(time.time())
+    start = end - config['window']
+    slices = []
+    while start < end:
+        slices.append((start, min(start + config['slice_seconds'], end)))
+        start = start + config['slice_seconds']
+    return slices
+
+def get_disk_states(nodes, wait):
+    # Fills 'results' with the disk state of every node that answered, and 'stale' with
+    # the rest. Both monitoring requests for every node (and every time slice of a long
+    # --window) are sent at once, each with its own 'wait' second timeout, so the run
+    # takes about as long as the slowest request.
+    requests = []
+    for node in nodes:
+        for metric in ('use', 'free'):
+            for start, end in time_slices():
+                requests.append((node, metric, wait, start, end))
+    pool_size = min(len(requests), config['max_requests'])
+    if cloudant_client.config['pool_size'] < pool_size:
+        cloudant_client.configure(pool_size)
+    if config['pool_size'] < pool_size:
+        config['pool'] = ThreadPool(pool_size)
+        config['pool_size'] = pool_size
+    datapoints = dict()
+    for node, metric, response in config['pool'].imap_unordered(get_datapoints, requests):
+        # Slices are joined up again here. One failed slice makes the node stale, so
+        # the first error replaces whatever slices arrived before it and is kept.
+        joined = datapoints.get((node, metric))
+        if isinstance(joined, str):
+            continue
+        elif isinstance(response, str):
+            datapoints[(node, metric)] = response
+        else:
+            datapoints.setdefault((node, metric), []).extend(response)
+
+    results.clear()
+    stale.clear()
+    answered = []
+    for node in nodes:
+        disk_used = datapoints[(node, 'use')]
+        disk_free = datapoints[(node, 'free')]
+        if isinstance(disk_used, str) or isinstance(disk_free, str):
+            # Errors come back as strings
+            stale[node] = disk_used if isinstance(disk_used, str) else disk_free
+        else:
+            answered.append(node)
+    if len(answered) == 0:
+        return
+
+    # Every node is analysed at once, one array row per node
+    used = stack_series([datapoints[(node, 'use')] for node in answered])
+    free = stack_series([datapoints[(node, 'free')] for node in answered])
+    history.clear()
+    if config['window'] is not None:
+        # Long histories are analysed as bucket means
+        bucket_times, used_min, used_max, used_mean = downsample(used)
+        bucket_times, free_min, free_max, free_mean = downsample(free)
+        for row, node in enumerate(answered):
+            history[node] = (bucket_times, used_min[row], used_max[row], used_mean[row], free_min[row], free_max[row], free_mean[row])
+        used = numpy.dstack((used_mean, numpy.broadcast_to(bucket_times, used_mean.shape)))
+        free = numpy.dstack((free_mean, numpy.broadcast_to(bucket_times, free_mean.shape)))
+    used_count, used_first, used_first_at, used_last, used_last_at, used_growth = analyse_series(used)
+    free_count, free_first, free_first_at, free_last, free_last_at, free_growth = analyse_series(free)
+    for row, node in enumerate(answered):
+        if used_count[row] == 0 or free_count[row] == 0:
+            stale[node] = "no valid statistics returned by API"
+            continue
+        growth = None
+        time_to_full = None
+        if not numpy.isnan(used_growth[row]):
+            growth = float(used_growth[row])
+            if growth > 0:
+                time_to_full = float(free_last[row]) / growth
+        results[node] = [
+            float(free_last[row]),
+            float(used_last[row]),
+            float(free_first[row]),
+            float(used_first[row]),
+            int(free_last_at[row] - free_first_at[row]),
+            growth,
+            time_to_full,
+            None,
+            float(free_last_at[row])
+        ]
+        if node in history:
+            # Highest point in the window, from the bucket maxima
+            results[node][7] = float(numpy.nanmax(history[node][2]))
+
+def stack_series(series_list):
+    # Monitoring datapoints are [value, timestamp] pairs, with null values where a sample is
+    # missing. Returns a (series, points, 2) array, with nulls and padding as NaN.
+    length = max(len(series) for series in series_list)
+    stacked = numpy.full((len(series_list), max(length, 1), 2), numpy.nan)
+    for row, series in enumerate(series_list):
+        if len(series) > 0:
+            stacked[row, :len(series)] = numpy.array(series, dtype=float)
+    return stacked
+
+def downsample(stacked):
+    # Reduces each series to one min, max and mean per --resolution bucket of the --window.
+    # Returns the bucket mid-times, then (series, buckets) min, max and mean arrays with
+    # NaN for empty buckets. Every series is bucketed at once with bincount and ufunc.at.
+    resolution = config['resolution']
+    buckets = max(int(numpy.ceil(config['window'] / float(resolution))), 1)
+    start = time.time() - config['window']
+    values = stacked[:, :, 0]
+    times = stacked[:, :, 1]
+    valid = ~(numpy.isnan(values) | numpy.isnan(times))
+    with numpy.errstate(invalid='ignore'):
+        bucket = numpy.clip((times - start) // resolution, 0, buckets - 1)
+    index = (numpy.arange(len(stacked))[:, None] * buckets + numpy.where(valid, bucket, 0))[valid].astype(int)
+    values = values[valid]
+    size = len(stacked) * buckets
+    count = numpy.bincount(index, minlength=size)
+    minimum = numpy.full(size, numpy.inf)
+    numpy.minimum.at(minimum, index, values)
+    maximum = numpy.full(size, -numpy.inf)
+    numpy.maximum.at(maximum, index, values)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.bincount(index, weights=values, minlength=size) / count
+    minimum[count == 0] = numpy.nan
+    maximum[count == 0] = numpy.nan
+    bucket_times = start + (numpy.arange(buckets) + 0.5) * resolution
+    shape = (len(stacked), buckets)
+    return bucket_times, minimum.reshape(shape), maximum.reshape(shape), mean.reshape(shape)
+
+def analyse_series(stacked):
+    # Returns, per series: the number of valid points, the first and last valid values and
+    # their times, and the growth per second from a least-squares fit over every valid point
+    # (NaN with fewer than two)
+    values = stacked[:, :, 0]
+    times = stacked[:, :, 1]
+    valid = ~(numpy.isnan(values) | numpy.isnan(times))
+    count = valid.sum(axis=1)
+    rows = numpy.arange(len(stacked))
+    first = valid.argmax(axis=1)
+    last = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_time = numpy.where(valid, times, 0).sum(axis=1) / count
+        mean_value = numpy.where(valid, values, 0).sum(axis=1) / count
+        time_offsets = numpy.where(valid, times - mean_time[:, None], 0)
+        value_offsets = numpy.where(valid, values - mean_value[:, None], 0)
+        spread = (time_offsets * time_offsets).sum(axis=1)
+        growth = numpy.where(
+            spread > 0,
+            (time_offsets * value_offsets).sum(axis=1) / spread,
+            numpy.nan
+        )
+    return count, values[rows, first], times[rows, first], values[rows, last], times[rows, last], growth
 
 def get_node_list(name):
     nodes = []
     myurl = 'https://' + name + '.cloudant.com/_membership'
-    r = requests.get(
+    r = cloudant_client.get(
         myurl,
         headers = my_header
     )
@@ -80,100 +305,277 @@ def get_node_list(name):
         nodes.append(int(nodenumber))
     return(nodes)
     
-def get_disk_state_of_node(node):
-
+def get_datapoints(request):
+    # Runs on a pool thread, so failures are returned as a message rather than exiting
+    node, metric, wait, start, end = request
     urlformat = 'https://{0}.cloudant.com/_api/v2/monitoring/node_disk_{1}_srv?cluster={2}&format=json&node=db{3}'
     myurl = urlformat.format(
         'cloudant',
-        'use',
+        metric,
         config['cluster'],
         node
     )
-
-    r = requests.get(
-        myurl,
-        headers = my_header
-    )
+    if start is not None:
+        myurl = '{0}&start={1}&end={2}'.format(myurl, start, end)
+    try:
+        r = cloudant_client.get(
+            myurl,
+            headers = my_header,
+            timeout = wait,
+            retries = 0 # A retry would run past the timeout
+        )
+    except Exception as e:
+        return node, metric, "no answer in {0}s ({1})".format(wait, e.__class__.__name__)
     if r.status_code not in (200,201,202):
-        print r.status_code
-        sys.exit("Cannot query node stats for " + str(node))
-    raw_json = r.json()
+        return node, metric, "HTTP {0} from disk {1} query".format(r.status_code, metric)
+    try:
+        return node, metric, r.json()['target_responses'][0]['datapoints']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return node, metric, "unreadable disk {0} response".format(metric)
+    
+def save_history(name):
+    # Appends this run's latest sample of each node, and any --window bucket means, to the
+    # local history used by --trend
+    samples = []
+    for node, result in results.iteritems():
+        samples.append((node, result[8], result[1], result[0]))
+    for node, series in history.iteritems():
+        bucket_times, used_mean, free_mean = series[0], series[3], series[6]
+        for i in numpy.nonzero(~(numpy.isnan(used_mean) | numpy.isnan(free_mean)))[0]:
+            samples.append((node, bucket_times[i], float(used_mean[i]), float(free_mean[i])))
+    store = cloudant_cache.DiskHistory()
+    store.add(config['cluster'], samples)
+    store.add_name(name, config['cluster'])
+    store.close()
 
-    disk_used = raw_json['target_responses'][0]['datapoints']
-    myurl = urlformat.format(
-        'cloudant',
-        'free',
-        config['cluster'],
-        node
-    )
+def get_placement(db):
+    # Runs on a pool thread. Returns the database, its file size and (q, {node: shard copies}),
+    # or None for the size if the database went away during the walk.
+    try:
+        entry = userdbs.get_stats(db)
+        placement = userdbs.config['cache'].get_placement(config['account'], db)
+        if placement is None or time.time() - placement[2] > config['placement_ttl']:
+            myurl = 'https://{0}.cloudant.com/{1}/_shards'.format(config['account'], db)
+            shards = userdbs.fetch_json(myurl)['shards']
+            nodes = dict()
+            for copies in shards.itervalues():
+                for copy in copies:
+                    node = node_number(copy)
+                    nodes[node] = nodes.get(node, 0) + 1
+            userdbs.config['cache'].put_placement(config['account'], db, len(shards), nodes)
+            placement = (len(shards), nodes, time.time())
+    except IOError:
+        return db, None, None
+    return db, entry['disk'], placement
 
-    r = requests.get(
-        myurl,
-        headers = my_header
-    )
-    if r.status_code not in (200,201,202):
-        print r.status_code
-        sys.exit("Cannot query node stats: " + node)
-    raw_json = r.json()
+def node_number(nodestring):
+    # 'dbcore@db12.<cluster>.cloudant.net' to 12
+    m = re.search('@db([0-9]+)\.', nodestring)
+    if m is None:
+        return nodestring
+    return int(m.group(1))
 
-    disk_free = raw_json['target_responses'][0]['datapoints']
-    
-    # Find earlist and latest valid data points in each set of results
-    # This behaves strangely if the API returns no timestamps.
-    current_free = get_last_valid(disk_free)
-    current_used = get_last_valid(disk_used)
-    previous_free = get_first_valid(disk_free)
-    previous_used = get_first_valid(disk_used)
-
-    if current_free == 0 or current_used == 0 or previous_free == 0 or previous_used == 0:
-        sys.exit("No valid statistics returned by API for db"+str(node))
-
-    node_data = [
-        node,
-        current_free[0],
-        current_used[0],
-        previous_free[0],
-        previous_used[0],
-        int(current_free[1] - previous_free[1])
-    ]
-
-    return node_data
-
-def get_last_valid(api_response):
-    valid = []
-    last = len(api_response) - 1
-    for i in range(last,-1,-1):
-        if isinstance(api_response[i][0],float):
-            valid = [api_response[i][0], api_response[i][1]]
-            return valid
-        else:
-            pass
-
-    # If below runs, we can't find any datapoints with timestamps.
-    print "No datapoints found!"
-    return 0
-
-def get_first_valid(api_response):
-    valid = []
-    last = len(api_response) - 1
-    for i in range(0,last):
-        if (isinstance(api_response[i][0],float)):
-            valid = [api_response[i][0], api_response[i][1]]
-            return valid
+def print_attribution(account, focus, top):
+    # Walks every database in the account on a bounded pool. The reported file size counts
+    # one copy of each shard range, so a node holding k of a database's shard copies is
+    # charged k/Q of it. Stats and shard maps come from the local cache where still fresh.
+    out = config['output']
+    config['account'] = account
+    userdbs.config['account'] = account
+    userdbs.config['my_header'] = my_header
+    userdbs.config['cache'] = cloudant_cache.StatsCache()
+    userdbs.config['refresh'] = True
+    dbcount = sum(1 for db in userdbs.iter_all_dbs())
+
+    attributed = dict() # Estimated bytes per node
+    databases = dict() # Databases with shards on each node
+    # Largest (bytes, db, copies, q) per node, kept to 'top' entries for the nodes ranked
+    if focus:
+        ranked = [int(node.lstrip('db')) for node in focus]
+    else:
+        ranked = None
+    rankings = dict()
+    on_node = dict() # Every database's bytes on every node, when the ranked node isn't known yet
+    for db, disk, placement in userdbs.pool_results(get_placement, userdbs.iter_all_dbs(), dbcount, ordered=False):
+        if disk is None:
+            continue
+        q, nodes, placed_at = placement
+        for node, copies in nodes.iteritems():
+            share = float(disk) * copies / q
+            attributed[node] = attributed.get(node, 0) + share
+            databases[node] = databases.get(node, 0) + 1
+            if ranked is None or node in ranked:
+                ranking = rankings.setdefault(node, [])
+                if len(ranking) < top:
+                    heapq.heappush(ranking, (share, db, copies, q))
+                elif share > ranking[0][0]:
+                    heapq.heapreplace(ranking, (share, db, copies, q))
+    userdbs.config['cache'].close()
+
+    if ranked is None:
+        # The fullest node by measurement, or by estimate if no node answered
+        if len(results) > 0:
+            ranked = [max(results, key=lambda node: results[node][1] / (results[node][0] + results[node][1]))]
         else:
-            pass
-        
-    # If below runs, we can't find any datapoints with timestamps.
-    print "No datapoints found!"
-    return 0
+            ranked = [max(attributed, key=attributed.get)]
+
+    if out.table:
+        print ""
+        print " Estimated disk use by the {0} databases of {1}, per node of cluster {2}".format(
+            userdbs.count_pretty(dbcount),
+            account,
+            config['cluster']
+        )
+        print " {0:>6} {1:>12} {2:>12} {3:>10}".format('Node', 'Measured', 'Estimated', 'Databases')
+    for node in sorted(attributed):
+        measured = results[node][1] if node in results else None
+        out.emit('node_attribution', OrderedDict([
+            ('cluster', config['cluster']),
+            ('node', 'db{0}'.format(node)),
+            ('used', measured),
+            ('attributed', attributed[node]),
+            ('databases', databases[node])
+        ]))
+        if out.table:
+            print " {0:>6} {1:>12} {2:>12} {3:>10}".format(
+                'db{0}'.format(node),
+                '-' if measured is None else data_size_pretty(measured),
+                data_size_pretty(attributed[node]),
+                databases[node]
+            )
+    for node in ranked:
+        ranking = sorted(rankings.get(node, []), reverse=True)
+        if out.table:
+            print ""
+            print " Largest databases on db{0}:".format(node)
+            print " {0:>4}  {1:<40} {2:>12} {3:>8} {4:>12}".format('#', 'Database', 'On node', 'Share', 'Shard copies')
+        for position, (share, db, copies, q) in enumerate(ranking):
+            percent = round(share / attributed[node] * 100, 1)
+            out.emit('attribution', OrderedDict([
+                ('cluster', config['cluster']),
+                ('node', 'db{0}'.format(node)),
+                ('rank', position + 1),
+                ('db', db),
+                ('bytes', share),
+                ('percent_of_node', percent),
+                ('shard_copies', copies),
+                ('q', q)
+            ]))
+            if out.table:
+                print " {0:>4}  {1:<40} {2:>12} {3:>7}% {4:>12}".format(
+                    position + 1,
+                    db[:40],
+                    data_size_pretty(share),
+                    percent,
+                    '{0}/{1}'.format(copies, q)
+                )
+    if out.table:
+        print ""
+
+def print_trend(name, days):
+    # Growth is fitted to every saved sample of each node, all nodes at once
+    out = config['output']
+    store = cloudant_cache.DiskHistory()
+    cluster = store.resolve(name)
+    rows = store.samples(cluster, time.time() - days * 86400)
+    store.close()
+    if len(rows) == 0:
+        sys.exit("No disk history saved for {0} in the last {1} days. Every cluster_disk.py run saves some.".format(name, days))
+    nodes = []
+    used_series = []
+    free_series = []
+    for node, at, used, free in rows:
+        if len(nodes) == 0 or nodes[-1] != node:
+            nodes.append(node)
+            used_series.append([])
+            free_series.append([])
+        used_series[-1].append([used, at])
+        free_series[-1].append([free, at])
+    used_count, used_first, used_first_at, used_last, used_last_at, growth = analyse_series(stack_series(used_series))
+    free_count, free_first, free_first_at, free_last, free_last_at, free_growth = analyse_series(stack_series(free_series))
+
+    capacity = used_last + free_last
+    daily_growth = growth * 86400
+    # Skew is how far each node's usage is from the average node's
+    skew = (used_last - used_last.mean()) / used_last.mean() * 100
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        to_90 = numpy.where(growth > 0, numpy.maximum(capacity * 0.9 - used_last, 0) / growth, numpy.nan)
+    total_growth = numpy.nansum(daily_growth)
+    total_used = used_last.sum()
+    total_capacity = capacity.sum()
+    if total_growth > 0:
+        total_to_90 = max(total_capacity * 0.9 - total_used, 0) / (total_growth / 86400)
+    else:
+        total_to_90 = None
+    span = (used_last_at.max() - used_first_at.min()) / 86400
+
+    if out.table:
+        print ""
+        print " Disk trend for cluster {0}: {1} samples over {2} days".format(cluster, len(rows), round(span, 1))
+    for i in range(len(nodes)):
+        node_growth = None if numpy.isnan(daily_growth[i]) else float(daily_growth[i])
+        node_to_90 = None if numpy.isnan(to_90[i]) else float(to_90[i])
+        out.emit('trend_node', OrderedDict([
+            ('cluster', cluster),
+            ('node', 'db{0}'.format(nodes[i])),
+            ('samples', int(used_count[i])),
+            ('used', float(used_last[i])),
+            ('percent_full', round(used_last[i] / capacity[i] * 100, 1)),
+            ('growth_bytes_per_day', node_growth),
+            ('skew_percent', round(skew[i], 1)),
+            ('seconds_to_90_percent', None if node_to_90 is None else int(node_to_90))
+        ]))
+        if out.table:
+            if node_growth is None:
+                growth_text = 'not enough samples'
+            else:
+                growth_text = '{0}{1}/day'.format('-' if node_growth < 0 else '+', data_size_pretty(abs(node_growth)))
+            print ' db{0:<3}:{1:>10} ({2:4}%)  Growth:{3:>16}  Skew:{4:>+6}%  90% in: {5}'.format(
+                nodes[i],
+                data_size_pretty(used_last[i]),
+                round(used_last[i] / capacity[i] * 100, 1),
+                growth_text,
+                round(skew[i], 1),
+                duration_pretty(node_to_90)
+            )
+    out.emit('trend_cluster', OrderedDict([
+        ('cluster', cluster),
+        ('nodes', len(nodes)),
+        ('samples', len(rows)),
+        ('days', round(span, 2)),
+        ('used', float(total_used)),
+        ('percent_full', round(total_used / total_capacity * 100, 1)),
+        ('growth_bytes_per_day', float(total_growth)),
+        ('max_skew_percent', round(float(numpy.abs(skew).max()), 1)),
+        ('seconds_to_90_percent', None if total_to_90 is None else int(total_to_90))
+    ]))
+    if out.table:
+        print ""
+        print ' TOTAL:{0:>10} ({1:4}%)  Growth: {2}/day  Largest skew: {3}%  90% in: {4}'.format(
+            data_size_pretty(total_used),
+            round(total_used / total_capacity * 100, 1),
+            data_size_pretty(total_growth),
+            round(float(numpy.abs(skew).max()), 1),
+            duration_pretty(total_to_90)
+        )
+        print ""
 
 def print_results():
-    print ""
-    print " Disk usage on the "+ str(len(results)) +" nodes of cluster: " + config['cluster']
+    out = config['output']
+    if out.table:
+        print ""
+        print " Disk usage on the "+ str(len(results)) +" nodes of cluster: " + config['cluster']
+        if config['window'] is not None:
+            print " History: last {0}, downsampled to {1} buckets".format(
+                duration_pretty(config['window']),
+                duration_pretty(config['resolution'])
+            )
     total_percent_change = 0
     total_disk_used = 0
     total_disk_free = 0
     total_disk_previous = 0
+    total_growth = 0
+    first_full = None # (seconds, node) of the node projected to fill first
     timediffs = []
     for key in sorted(results):
         result = results[key]
@@ -186,6 +588,22 @@ def print_results():
         total_disk_free = total_disk_free + result[0]
         timediff = (result[4] / 60)
         timediffs.append(timediff)
+        if result[5] is not None:
+            total_growth = total_growth + result[5]
+        if result[6] is not None and (first_full is None or result[6] < first_full[0]):
+            first_full = (result[6], key)
+        out.emit('node', OrderedDict([
+            ('cluster', config['cluster']),
+            ('node', 'db{0}'.format(key)),
+            ('used', disk_used),
+            ('free', result[0]),
+            ('percent_full', percent_full),
+            ('change', change),
+            ('interval_seconds', result[4]),
+            ('growth_bytes_per_second', result[5]),
+            ('seconds_to_full', None if result[6] is None else int(result[6])),
+            ('peak_used', result[7])
+        ]))
         if percent_full > 90:
             tag = '*'
         else:
@@ -198,7 +616,9 @@ def print_results():
             plusornot = "-"
             percent_change = abs(percent_change)
             change = abs(change)
-        print ' db{0:<3}:{1:>10} ({2:4}%){3} Change:{4}{5:>10} ({6}{7:4}% in {8:1}min)'.format(
+        if not out.table:
+            continue
+        print ' db{0:<3}:{1:>10} ({2:4}%){3} Change:{4}{5:>10} ({6}{7:4}% in {8:1}min)  Full in: {9}'.format(
             key,
             data_size_pretty(disk_used),
             percent_full,
@@ -207,12 +627,42 @@ def print_results():
             data_size_pretty(change),
             plusornot,
             percent_change,
-            timediff
-        )
+            timediff,
+            duration_pretty(result[6])
+        ) + ('' if result[7] is None else '  Peak: {0}'.format(data_size_pretty(result[7])))
+    for key in sorted(stale):
+        out.emit('stale', OrderedDict([
+            ('cluster', config['cluster']),
+            ('node', 'db{0}'.format(key)),
+            ('reason', stale[key])
+        ]))
+        if out.table:
+            print ' db{0:<3}: stale, {1}'.format(key, stale[key])
+    if len(results) == 0:
+        sys.exit("No node returned disk status. Increase the timeout or check cluster status.")
     total_change = total_disk_used - total_disk_previous
     total_percent_change = round(((total_disk_used - total_disk_previous) / total_disk_previous) * 100, 1)
     total_timediff = int(round(numpy.mean(timediffs)))
     total_percent_full = round((total_disk_used / (total_disk_free + total_disk_used)) * 100, 1)
+    # Assumes data keeps landing evenly across nodes; first_full is the earlier warning
+    if total_growth > 0:
+        total_to_full = total_disk_free / total_growth
+    else:
+        total_to_full = None
+    out.emit('cluster', OrderedDict([
+        ('cluster', config['cluster']),
+        ('nodes', len(results)),
+        ('stale_nodes', len(stale)),
+        ('used', total_disk_used),
+        ('free', total_disk_free),
+        ('percent_full', total_percent_full),
+        ('change', total_change),
+        ('growth_bytes_per_second', total_growth),
+        ('seconds_to_full', None if total_to_full is None else int(total_to_full)),
+        ('first_node_seconds_to_full', None if first_full is None else int(first_full[0]))
+    ]))
+    if not out.table:
+        return
     if total_change > 0:
         total_plusornot = "+"
     elif total_change < 0:
@@ -220,7 +670,7 @@ def print_results():
         total_percent_change = abs(total_percent_change)
         total_change = abs(total_change)
     else:
-        plusornot = ' '
+        total_plusornot = ' '
     print ""
     print ' TOTAL:{0:>10} ({1:4}%)  Change:{2}{3:>10} ({4}{5:4}% in {6:1}min)'.format(
         data_size_pretty(total_disk_used),
@@ -231,8 +681,23 @@ def print_results():
         total_percent_change,
         total_timediff
     )
+    print ' Cluster full in: {0}'.format(duration_pretty(total_to_full))
+    if first_full is not None:
+        print ' First node full: db{0} in {1}'.format(first_full[1], duration_pretty(first_full[0]))
+    if len(stale) > 0:
+        print ' ({0} stale nodes not included)'.format(len(stale))
     print ""
 
+def duration_pretty(seconds):
+    # Projections are rough, so only a few digits are shown. None is a disk that isn't filling.
+    if seconds is None:
+        return 'never'
+    elif seconds >= 86400:
+        return '{0} days'.format(round(seconds / 86400, 1))
+    elif seconds >= 3600:
+        return '{0} hours'.format(round(seconds / 3600, 1))
+    return '{0} min'.format(int(seconds / 60))
+
 def data_size_pretty(size):
     measure = 0
     size = float(size)
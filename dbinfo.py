@@ -25,7 +25,12 @@
  # For total # of conflicts in the database:
  #   -x
 
-import time, argparse, string, os, sys, re, json, requests
+import time, argparse, string, os, sys, re, json, threading, random, bisect
+import cloudant_client
+import cloudant_cache
+import cloudant_output
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 def getargs():
     argparser = argparse.ArgumentParser(description = 'Get helpful information about a database inside Cloudant DBaaS')
@@ -59,14 +64,52 @@ def getargs():
         action='store_true',
         help = 'Be verbose'
     )
+    argparser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help = 'Number of key ranges to scan in parallel with -x (default: 1)'
+    )
+    argparser.add_argument(
+        '--engine',
+        choices=['docs', 'changes'],
+        default='docs',
+        help = 'Conflict scan engine for -x: "docs" reads document bodies, "changes" reads revision metadata only (default: docs)'
+    )
+    argparser.add_argument(
+        '--resume',
+        action='store_true',
+        help = 'Resume an interrupted -x scan from its checkpoint file'
+    )
+    argparser.add_argument(
+        '--checkpoint',
+        type=str,
+        metavar='FILE',
+        help = 'Checkpoint file for -x scans (default: dbinfo-<account>-<database>.checkpoint)'
+    )
+    argparser.add_argument(
+        '--reprobe',
+        action='store_true',
+        help = 'Measure -x scan cost again instead of using the saved probe for this database'
+    )
+    cloudant_output.add_argument(argparser)
     return argparser.parse_args()
 
 class DBInfo(object):
     
-    def __init__(self, account, dbname, verbose):
+    def __init__(self, account, dbname, verbose, workers=1, engine='docs', resume=False, checkpoint_file=None, reprobe=False, formats=None):
         self.account = account
         self.dbname = dbname
         self.verbose = verbose
+        self.workers = max(workers, 1)
+        self.engine = engine
+        self.resume = resume
+        if checkpoint_file is None:
+            checkpoint_file = 'dbinfo-{0}-{1}.checkpoint'.format(account, re.sub('[^A-Za-z0-9_.-]', '_', dbname))
+        self.checkpoint_file = checkpoint_file
+        self.reprobe = reprobe
+        self.out = cloudant_output.Output(formats, 'dbinfo')
         
         # Set authentication up. Default to admin auth.
         adminauthstring = os.environ.get('CLOUDANT_ADMIN_AUTH')
@@ -77,32 +120,62 @@ class DBInfo(object):
             sys.exit("ERROR: Required environment variables not set")
         self.my_header = {'Content-Type': 'application/json', 'Authorization': authstring}
         
-        # Cluster and shard data.
-        self.cluster = '' # (Filled in by function below)
-        self.shards = self.get_shards()
-        
         # Statistics to fill in
         self.doc_count = 0
         self.datasizes = []
         self.del_doc_est_size = 0
         self.percent_overhead = 0
         self.db_size = 0
+        self.external_size = 0
         
         # Constants
-        self.time_estimate_ratio = (4 * 60.0) / 144250.0 # estimated number of seconds per doc based on 4kb doc size
         self.batch = 10000 # Number of docs returned in each GET query for the conflict scan
+        self.confirm_batch = 100 # Number of docs fetched in each query to confirm --engine changes conflicts
         self.too_long = 120 # Number of seconds that triggers the script to confirm if user really wants conflict scan
         self.fatal_too_long = 3600 # number of seconds that we offer an alternative to perform a conflict scan
         self.too_big = 50 * 1024 * 1024 # data size version of too_long (bytes)
         self.fatal_too_big = 1024 * 1024 * 1024 # data size version of fatal_too_long (bytes)
+        self.key_width = 3 # Number of leading doc ID characters used to split the keyspace between scan workers
+        self.key_samples = 8 # Number of doc IDs sampled for each key range when placing the range boundaries
+        self.key_digits = [chr(i) for i in range(128)] # Characters read as the digits of a doc ID, see key_to_number
+        self.bar_width = 40 # Width of the conflict scan progress bar
+        self.checkpoint_pages = 10 # Number of conflict scan pages between checkpoint writes
+        self.probe_pages = 5 # Number of pages fetched at random keys to estimate conflict scan cost
+        self.probe_size = 100 # Number of docs in each probe page
+        self.probe_max_age = 7 * 24 * 3600 # Seconds before a saved probe result is measured again
+        self.index_workers = 10 # Number of index size requests made at once for -i
+        self.probe_file = cloudant_cache.state_path('probes.json')
+
+        # Conflict scan progress, shared between scan workers
+        self.progress_lock = threading.Lock()
+        self.scan_states = []
+        self.scanned_rows = 0
+        self.scanned_pages = 0
+        self.resumed_rows = 0
+        self.bar_ticks = 0
+        self.bytes_transferred = 0
+
+        # Keep enough connections open for the busiest worker pool
+        cloudant_client.configure(max(self.workers, self.index_workers))
+        
+        # Cluster and shard data.
+        self.cluster = '' # (Filled in by function below)
+        self.shards = self.get_shards()
         
     def json_get(self, url):
-        r = requests.get(
+        try:
+            return self.fetch_json(url)
+        except IOError:
+            sys.exit("Failed, bad HTTP response")
+
+    def fetch_json(self, url):
+        # Raises instead of exiting, for use from worker threads
+        r = cloudant_client.get(
             url,
             headers = self.my_header
         )
         if r.status_code not in (200,201,202):
-            sys.exit("Failed, bad HTTP response")
+            raise IOError("HTTP {0} from {1}".format(r.status_code, url))
         return r.json()
     
     def get_summary(self):
@@ -117,105 +190,512 @@ class DBInfo(object):
         if (stats['doc_count'] == 0 and not print_shards):
             sys.exit(" Database exists, but is empty. Exiting")
         self.doc_count = stats['doc_count']
-        print ""
-        print " Summary Info for Cloudant Database: \"{0}\"  In Account: \"{1}\"".format(self.dbname,self.account)
         shardcount = len(self.shards)
         nvalue = len(self.shards.itervalues().next())
-        print " Unique shards (Q): {0}  Replica setting (N): {1}".format(shardcount,nvalue)
         counts = [
             self.count_pretty(stats['doc_count']),
             self.count_pretty(stats['doc_del_count'])
         ]
-        print " JSON Document Count: {0} with {1} deleted doc 'tombstones'".format(counts[0],counts[1])
-        
-        #print stats
         
         # Account for small or empty databases, where the API gets weird on disk space
         if stats['sizes']['active'] == None:
-            self.datasizes.append(self.data_size_pretty(stats['sizes']['external']))
+            active = stats['sizes']['external']
         else:
-            self.datasizes.append(self.data_size_pretty(stats['sizes']['active']))
-        
+            active = stats['sizes']['active']
+        self.datasizes.append(self.data_size_pretty(active))
         self.datasizes.append(self.data_size_pretty(stats['sizes']['file']))
         
-        print " JSON Data size: {0} operating, {1} on disk".format(self.datasizes[0],self.datasizes[1])
-        
         self.del_doc_est_size = stats['doc_del_count'] * 200 # 127 bytes of JSON and some allowances for disk overhead
-        
-        print " Estimated space overhead from tombstones: {0}".format(self.data_size_pretty(self.del_doc_est_size))
-        
         self.percent_overhead = (float(stats['doc_del_count']) / float(stats['doc_count'])) * 100
-        
-        print " Estimated primary index overhead from tombstones: {0} %".format(round(self.percent_overhead,2))
         self.db_size = stats['sizes']['active']
+        self.external_size = stats['sizes']['external']
+
+        self.out.emit('summary', OrderedDict([
+            ('account', self.account),
+            ('db', self.dbname),
+            ('shardcount', shardcount),
+            ('nvalue', nvalue),
+            ('doc_count', stats['doc_count']),
+            ('del_doc_count', stats['doc_del_count']),
+            ('active', active),
+            ('disk', stats['sizes']['file']),
+            ('tombstone_size_estimate', self.del_doc_est_size),
+            ('tombstone_percent_overhead', round(self.percent_overhead, 2))
+        ]))
+        if not self.out.table:
+            return
+        print ""
+        print " Summary Info for Cloudant Database: \"{0}\"  In Account: \"{1}\"".format(self.dbname,self.account)
+        print " Unique shards (Q): {0}  Replica setting (N): {1}".format(shardcount,nvalue)
+        print " JSON Document Count: {0} with {1} deleted doc 'tombstones'".format(counts[0],counts[1])
+        print " JSON Data size: {0} operating, {1} on disk".format(self.datasizes[0],self.datasizes[1])
+        print " Estimated space overhead from tombstones: {0}".format(self.data_size_pretty(self.del_doc_est_size))
+        print " Estimated primary index overhead from tombstones: {0} %".format(round(self.percent_overhead,2))
         print ""
     
     def get_conflicts(self):
-        est_time = self.doc_count * self.time_estimate_ratio
-        if (est_time > self.fatal_too_long or self.db_size > self.fatal_too_big):
+        if self.engine == 'changes' or self.resume:
+            # Metadata-only or already confirmed scan, the bandwidth and time limits don't apply
+            est_time = 0
+            est_size = 0
+        else:
+            probe = self.get_probe()
+            pages = (self.doc_count / self.batch) + 1
+            est_time = ((pages * probe['latency']) + (self.doc_count * probe['seconds_per_doc'])) / self.workers
+            est_size = self.doc_count * probe['bytes_per_doc']
+        if (est_time > self.fatal_too_long or est_size > self.fatal_too_big) and not self.out.table:
+            sys.stderr.write(" Conflict scan skipped, it would need an estimated {0} of bandwidth and {1} to complete\n".format(
+                self.data_size_pretty(est_size),
+                self.pretty_time(est_time)
+                ))
+            return
+        elif (est_time > self.fatal_too_long or est_size > self.fatal_too_big):
             print " A conflict scan for \"{0}\" would need an estimated {1} of bandwidth and {2} to complete".format(
                 self.dbname,
-                self.data_size_pretty(self.db_size),
+                self.data_size_pretty(est_size),
                 self.pretty_time(est_time)
                 )
-            print " Create a view to perform this operation instead. \n Follow the instructions found at:"
+            print " Use \"--engine changes\" or create a view to perform this operation instead. \n Follow the instructions found at:"
             print " https://docs.cloudant.com/mvcc.html#distributed-databases-and-conflicts"
             return
-        elif (est_time > self.too_long) or (self.db_size > self.too_big):
+        elif ((est_time > self.too_long) or (est_size > self.too_big)) and self.out.table:
+            # (Machine-readable runs don't stop to ask)
             print " !!!ATTENTION!!! Conflict scan will need {0} of bandwidth and take about {1} !!!ATTENTION!!!".format(
-                self.data_size_pretty(self.db_size),
+                self.data_size_pretty(est_size),
                 self.pretty_time(est_time)
                 )
             yes = raw_input(" Are you sure? (Y/N): ")
             if yes not in ("y","Y"):
                 return
-        print "     Scanning for conflicts. Progress:"
-        rows = 0
-        progress = 0
-        conflict_count = 0
-        bar_width = 40
-        bar_increment = self.doc_count / bar_width
-        sys.stdout.write("[%s]" % (" " * bar_width))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (bar_width + 1 ))
-        starttime = time.time()
-        
-        def increment():
-            if (int(progress) / int(bar_increment)) == (int(progress) / float(bar_increment)):
-                return True
+        if self.resume:
+            self.scan_states = self.load_checkpoint()
+        elif self.engine == 'changes':
+            # The changes feed can't be split by key, so it's read by a single worker
+            self.scan_states = [dict(since = None)]
+        else:
+            # Split the doc ID keyspace so each worker scans its own slice of _all_docs.
+            # More ranges than workers keeps every worker busy when the IDs are unevenly spread.
+            if self.workers > 1:
+                key_ranges = self.get_key_ranges(self.workers * 4)
             else:
-                return False
-    
-        while (progress < self.doc_count):
-            myurl = 'https://{0}.cloudant.com/{1}/_all_docs?include_docs=true&conflicts=true&limit={2}&skip={3}'.format(
-                self.account,
-                self.dbname,
-                self.batch,
-                rows
-                )
-            r = self.json_get(myurl)
-            
-            # find any incidents of conflicts in rows:
-            if len(r['rows']) > 0:
-                for row in r['rows']:
-                    try:
-                        conflicts = len(row['doc']['_conflicts'])
-                        conflict_count = conflict_count + conflicts
-                    except:
-                        pass
-                    progress = progress + 1
-                    if (increment()):
-                        sys.stdout.write("-")
-                        sys.stdout.flush()
-                rows = rows + len(r['rows'])
-            
-        sys.stdout.write("\n")
+                key_ranges = [(None, None)]
+            self.scan_states = []
+            for startkey, endkey in key_ranges:
+                self.scan_states.append(dict(
+                    startkey = startkey,
+                    endkey = endkey,
+                    last_key = None
+                ))
+        for state in self.scan_states:
+            state.setdefault('rows', 0)
+            state.setdefault('conflicts', 0)
+            state.setdefault('done', False)
+
+        if not self.out.table:
+            pass
+        elif self.engine == 'changes':
+            print "     Scanning revision metadata for conflicts. Progress:"
+        else:
+            print "     Scanning for conflicts with {0} worker(s). Progress:".format(self.workers)
+        self.scanned_rows = sum(state['rows'] for state in self.scan_states)
+        self.scanned_pages = 0
+        self.bar_ticks = 0
+        self.bytes_transferred = 0
+        if self.show_bar():
+            sys.stdout.write("[%s]" % (" " * self.bar_width))
+            sys.stdout.flush()
+            sys.stdout.write("\b" * (self.bar_width + 1 ))
+        starttime = time.time()
+
+        first_rates = []
+        last_rates = []
+        p = ThreadPool(self.workers)
+        if self.engine == 'changes':
+            results = p.imap_unordered(self.scan_changes, self.scan_states)
+        else:
+            results = p.imap_unordered(self.scan_range, self.scan_states)
+        try:
+            for page_rates in results:
+                if len(page_rates) > 0:
+                    first_rates.append(page_rates[0])
+                    last_rates.append(page_rates[-1])
+        except IOError as e:
+            with self.progress_lock:
+                self.save_checkpoint()
+            sys.exit("Failed, bad HTTP response: {0}\n Progress saved to {1}, rerun with --resume to continue".format(
+                e,
+                self.checkpoint_file
+            ))
+        finally:
+            p.close()
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+        rows = sum(state['rows'] for state in self.scan_states)
+        conflict_count = sum(state['conflicts'] for state in self.scan_states)
+        if self.show_bar():
+            sys.stdout.write("\n")
         endtime = time.time()
         totaltime = endtime - starttime
+        self.out.emit('conflicts', OrderedDict([
+            ('account', self.account),
+            ('db', self.dbname),
+            ('engine', self.engine),
+            ('conflicts', conflict_count),
+            ('rows', rows),
+            ('seconds', round(totaltime, 2)),
+            ('bytes_transferred', self.bytes_transferred)
+        ]))
+        if not self.out.table:
+            return
         print " {0} conflicts found in {1}".format(
             conflict_count,
             self.pretty_time(totaltime))
+        if totaltime > 0 and len(first_rates) > 0:
+            print " {0} rows at {1} rows/sec (first page: {2} rows/sec, last page: {3} rows/sec)".format(
+                self.count_pretty(rows),
+                self.count_pretty(int((rows - self.resumed_rows) / totaltime)),
+                self.count_pretty(int(sum(first_rates) / len(first_rates))),
+                self.count_pretty(int(sum(last_rates) / len(last_rates)))
+            )
+        print " {0} transferred (an include_docs scan transfers about {1})".format(
+            self.data_size_pretty(self.bytes_transferred),
+            self.data_size_pretty(self.external_size)
+        )
         print ""
+
+    def show_bar(self):
+        # The progress bar is only drawn for table output, and is replaced by per-page lines with -v
+        return self.out.table and not self.verbose
+
+    def scan_range(self, state):
+        # Scans one [startkey, endkey) slice of _all_docs for conflicts.
+        # Pages by key rather than by skip, so each page costs the same
+        # no matter how deep into the database the scan is.
+        page_rates = []
+        if state['done']:
+            return page_rates
+        myurl = 'https://{0}.cloudant.com/{1}/_all_docs'.format(self.account, self.dbname)
+        params = dict(
+            include_docs = 'true',
+            conflicts = 'true',
+            limit = self.batch
+        )
+        if state['startkey'] is not None:
+            params['startkey'] = json.dumps(state['startkey'])
+        if state['endkey'] is not None:
+            params['endkey'] = json.dumps(state['endkey'])
+            params['inclusive_end'] = 'false'
+        label = '{0!r} - {1!r}'.format(state['startkey'], state['endkey'])
+        while True:
+            if state['last_key'] is not None:
+                params['startkey'] = json.dumps(state['last_key'])
+                params['skip'] = 1
+            page = dict(
+                rows = 0,
+                conflicts = 0,
+                last_key = state['last_key']
+            )
+            page_start = time.time()
+            for row in self.stream_rows(myurl, params):
+                if '_conflicts' in row['doc']:
+                    page['conflicts'] = page['conflicts'] + len(row['doc']['_conflicts'])
+                page['last_key'] = row['id']
+                page['rows'] = page['rows'] + 1
+            page_time = time.time() - page_start
+            if page['rows'] > 0 and page_time > 0:
+                page_rates.append(page['rows'] / page_time)
+            self.scan_progress(state, page, label, page_rates)
+            if state['done']:
+                return page_rates
+
+    def scan_changes(self, state):
+        # Finds conflicts from revision tree metadata. With style=all_docs the changes
+        # feed lists every leaf revision of a document, deleted ones included, so only
+        # documents with more than one leaf can be in conflict. Only those documents'
+        # bodies are fetched, to count their live conflicts.
+        page_rates = []
+        if state['done']:
+            return page_rates
+        myurl = 'https://{0}.cloudant.com/{1}/_changes'.format(self.account, self.dbname)
+        params = dict(
+            style = 'all_docs',
+            limit = self.batch
+        )
+        while True:
+            if state['since'] is not None:
+                params['since'] = state['since']
+            page = dict(
+                rows = 0,
+                conflicts = 0,
+                since = state['since']
+            )
+            page_start = time.time()
+            candidates = []
+            for row in self.stream_rows(myurl, params, '{"seq"'):
+                if not row.get('deleted', False) and len(row['changes']) > 1:
+                    candidates.append(row['id'])
+                page['since'] = row['seq']
+                page['rows'] = page['rows'] + 1
+            page['conflicts'] = self.count_live_conflicts(candidates)
+            page_time = time.time() - page_start
+            if page['rows'] > 0 and page_time > 0:
+                page_rates.append(page['rows'] / page_time)
+            self.scan_progress(state, page, '_changes', page_rates)
+            if state['done']:
+                return page_rates
+
+    def count_live_conflicts(self, doc_ids):
+        # A resolved conflict leaves a deleted leaf behind, which the changes feed still
+        # lists. _conflicts holds only the live ones.
+        myurl = 'https://{0}.cloudant.com/{1}/_all_docs'.format(self.account, self.dbname)
+        conflicts = 0
+        for i in range(0, len(doc_ids), self.confirm_batch):
+            params = dict(
+                include_docs = 'true',
+                conflicts = 'true',
+                keys = json.dumps(doc_ids[i:i + self.confirm_batch])
+            )
+            for row in self.stream_rows(myurl, params):
+                # Documents deleted since the feed was read come back without a body
+                if row.get('doc') is not None and '_conflicts' in row['doc']:
+                    conflicts = conflicts + len(row['doc']['_conflicts'])
+        return conflicts
+
+    def scan_progress(self, state, page, label, page_rates):
+        # Called from every scan worker once per page. The page is folded into the
+        # scan state in one step, so a checkpoint never holds half a page.
+        with self.progress_lock:
+            state['rows'] = state['rows'] + page['rows']
+            state['conflicts'] = state['conflicts'] + page['conflicts']
+            if 'last_key' in page:
+                state['last_key'] = page['last_key']
+            else:
+                state['since'] = page['since']
+            if page['rows'] < self.batch:
+                state['done'] = True
+            self.scanned_rows = self.scanned_rows + page['rows']
+            self.scanned_pages = self.scanned_pages + 1
+            if self.scanned_pages % self.checkpoint_pages == 0:
+                self.save_checkpoint()
+            if not self.out.table:
+                pass
+            elif self.verbose:
+                if len(page_rates) > 0:
+                    rate = self.count_pretty(int(page_rates[-1]))
+                else:
+                    rate = 0
+                print "  [{0}] {1:>12} rows scanned, {2:>10} rows/sec this page".format(
+                    label,
+                    self.count_pretty(state['rows']),
+                    rate
+                )
+            else:
+                bar_increment = max(self.doc_count / self.bar_width, 1)
+                ticks = min(self.scanned_rows / bar_increment, self.bar_width)
+                if ticks > self.bar_ticks:
+                    sys.stdout.write("-" * (ticks - self.bar_ticks))
+                    sys.stdout.flush()
+                    self.bar_ticks = ticks
+
+    def save_checkpoint(self):
+        # Caller must hold progress_lock. Written to a temporary file first so an
+        # interrupted write never replaces a good checkpoint.
+        checkpoint = dict(
+            account = self.account,
+            dbname = self.dbname,
+            engine = self.engine,
+            states = self.scan_states
+        )
+        tempfile = self.checkpoint_file + '.tmp'
+        with open(tempfile, 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(tempfile, self.checkpoint_file)
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError) as e:
+            sys.exit("ERROR: Cannot read checkpoint {0}: {1}".format(self.checkpoint_file, e))
+        if (checkpoint['account'], checkpoint['dbname'], checkpoint['engine']) != (self.account, self.dbname, self.engine):
+            sys.exit("ERROR: Checkpoint {0} is for a different database or engine".format(self.checkpoint_file))
+        self.resumed_rows = sum(state['rows'] for state in checkpoint['states'])
+        if self.out.table:
+            print " Resuming conflict scan from {0} with {1} rows already scanned".format(
+                self.checkpoint_file,
+                self.count_pretty(self.resumed_rows)
+            )
+        return checkpoint['states']
+
+    def get_probe(self):
+        # Measures what a conflict scan page costs on this database by fetching a few
+        # small pages at random keys. Results are saved per account/database so later
+        # runs can skip the probe.
+        probes = dict()
+        if os.path.exists(self.probe_file):
+            with open(self.probe_file) as f:
+                probes = json.load(f)
+        probe_id = '{0}/{1}'.format(self.account, self.dbname)
+        if (not self.reprobe and probe_id in probes and
+                time.time() - probes[probe_id]['probed_at'] < self.probe_max_age):
+            return probes[probe_id]
+
+        # The key bound lookups fetch no documents, so they time the fixed cost of a request
+        start = time.time()
+        bounds = self.get_key_bounds()
+        latency = (time.time() - start) / 2
+        myurl = 'https://{0}.cloudant.com/{1}/_all_docs'.format(self.account, self.dbname)
+        docs = 0
+        doc_bytes = 0
+        doc_time = 0.0
+        for i in range(self.probe_pages):
+            params = dict(
+                include_docs = 'true',
+                conflicts = 'true',
+                limit = self.probe_size
+            )
+            if bounds is not None and i > 0:
+                params['startkey'] = json.dumps(self.number_to_key(random.randint(bounds[0], bounds[1] - 1)))
+            start = time.time()
+            r = cloudant_client.get(
+                myurl,
+                headers = self.my_header,
+                params = params
+            )
+            elapsed = time.time() - start
+            if r.status_code not in (200,201,202):
+                sys.exit("Failed, bad HTTP response")
+            docs = docs + len(r.json()['rows'])
+            doc_bytes = doc_bytes + len(r.content)
+            doc_time = doc_time + max(elapsed - latency, 0)
+        docs = max(docs, 1)
+        probe = dict(
+            latency = latency,
+            seconds_per_doc = doc_time / docs,
+            bytes_per_doc = doc_bytes / float(docs),
+            probed_at = time.time()
+        )
+        if self.verbose and self.out.table:
+            print " Probe: {0} request latency, {1} per doc, {2} per doc".format(
+                self.pretty_time(probe['latency']),
+                self.pretty_time(probe['seconds_per_doc']),
+                self.data_size_pretty(probe['bytes_per_doc'])
+            )
+        probes[probe_id] = probe
+        with open(self.probe_file, 'w') as f:
+            json.dump(probes, f)
+        return probe
+
+    def get_key_bounds(self, digits=None):
+        # Returns the first and last doc IDs as numbers (see key_to_number) or None if
+        # the database has no documents
+        myurl = 'https://{0}.cloudant.com/{1}/_all_docs?limit=1'.format(self.account, self.dbname)
+        first_rows = self.json_get(myurl)['rows']
+        last_rows = self.json_get(myurl + '&descending=true')['rows']
+        if len(first_rows) == 0:
+            return None
+        return (
+            self.key_to_number(first_rows[0]['id'], digits),
+            self.key_to_number(last_rows[0]['id'], digits) + 1
+        )
+
+    def get_key_ranges(self, parts):
+        # Divides the doc IDs into disjoint [startkey, endkey) ranges holding roughly
+        # equal numbers of documents, with boundaries at quantiles of sampled IDs.
+        # Evenly spaced keys only find evenly spread IDs when the IDs use every code
+        # point, and hex IDs use 16 of 128. So a first pass finds the characters the
+        # IDs are made of, and the sample is taken at keys made of those characters.
+        bounds = self.get_key_bounds()
+        if bounds is None:
+            return [(None, None)]
+        digits = sorted(set(''.join(self.sample_ids(bounds, None, parts))))
+        ids = self.sample_ids(self.get_key_bounds(digits), digits, parts * self.key_samples)
+        boundaries = []
+        for i in range(1, parts):
+            boundary = ids[len(ids) * i / parts]
+            # (The first ID starts the first range already)
+            if boundary != ids[0] and (len(boundaries) == 0 or boundary != boundaries[-1]):
+                boundaries.append(boundary)
+        return zip([None] + boundaries, boundaries + [None])
+
+    def sample_ids(self, bounds, digits, samples):
+        # Returns the distinct doc IDs found at evenly spaced keys between bounds, sorted
+        low, high = bounds
+        samples = min(samples, high - low)
+        startkeys = [self.number_to_key(low + ((high - low) * i / samples), digits) for i in range(samples)]
+        p = ThreadPool(self.workers)
+        try:
+            found = p.map(self.get_next_id, startkeys)
+        except IOError as e:
+            sys.exit("Failed, bad HTTP response: {0}".format(e))
+        finally:
+            p.close()
+        return sorted(set(doc_id for doc_id in found if doc_id is not None))
+
+    def get_next_id(self, startkey):
+        # Returns the first doc ID at or after startkey, or None past the last one.
+        # Runs on a pool thread, so failures raise IOError rather than exiting.
+        myurl = 'https://{0}.cloudant.com/{1}/_all_docs'.format(self.account, self.dbname)
+        r = cloudant_client.get(
+            myurl,
+            headers = self.my_header,
+            params = dict(limit = 1, startkey = json.dumps(startkey))
+        )
+        if r.status_code not in (200,201,202):
+            raise IOError("HTTP {0} from {1}".format(r.status_code, myurl))
+        rows = r.json()['rows']
+        if len(rows) == 0:
+            return None
+        return rows[0]['id']
+
+    def key_to_number(self, key, digits=None):
+        # Reads the leading characters of a key as the digits of a number, each worth
+        # its place in digits (by default every 7-bit code point, in order)
+        if digits is None:
+            digits = self.key_digits
+        number = 0
+        for i in range(self.key_width):
+            if i < len(key):
+                digit = min(bisect.bisect_left(digits, key[i]), len(digits) - 1)
+            else:
+                digit = 0
+            number = (number * len(digits)) + digit
+        return number
+
+    def number_to_key(self, number, digits=None):
+        if digits is None:
+            digits = self.key_digits
+        chars = []
+        for i in range(self.key_width):
+            chars.append(digits[number % len(digits)])
+            number = number / len(digits)
+        return ''.join(reversed(chars)).rstrip('\x00')
+
+    def stream_rows(self, url, params, row_start='{"id"'):
+        # Yields rows from a view or changes response as they come off the wire.
+        # Cloudant writes one row per line, so the full response never has to sit in memory.
+        r = cloudant_client.get(
+            url,
+            headers = self.my_header,
+            params = params,
+            stream = True
+        )
+        if r.status_code not in (200,201,202):
+            raise IOError("HTTP {0} from {1}".format(r.status_code, url))
+        for line in r.iter_lines():
+            with self.progress_lock:
+                self.bytes_transferred = self.bytes_transferred + len(line) + 1
+            line = line.strip().strip(',')
+            if line.startswith(row_start):
+                yield json.loads(line)
+            elif line.startswith('{"total_rows"') and line.endswith('}'):
+                # Whole response on a single line
+                for row in json.loads(line)['rows']:
+                    yield row
+            elif line.startswith('{"results"') and line.endswith('}'):
+                for row in json.loads(line)['results']:
+                    yield row
     
     def count_pretty(self, size):
         return "{:,}".format(size)
@@ -241,11 +721,34 @@ class DBInfo(object):
         return json_response['shards']
         
     def get_indexes(self):
-        myurl = 'https://{0}.cloudant.com/{1}/_all_docs?startkey="_design/"&endkey="_design0"'.format(
+        # All design documents come back in one request
+        myurl = 'https://{0}.cloudant.com/{1}/_all_docs?startkey="_design/"&endkey="_design0"&include_docs=true'.format(
             self.account,
             self.dbname
             )
         json_response = self.json_get(myurl)
+        ddocs = [row['doc'] for row in json_response['rows']]
+        
+        # Index sizes are fetched concurrently, then printed in design document order
+        lookups = []
+        for ddoc_content in ddocs:
+            ddoc_name = re.sub('_design/', '', ddoc_content['_id'])
+            for key,value in ddoc_content.items():
+                if (key == "views" and len(value) > 0):
+                    lookups.append(('Views', ddoc_name, None))
+                elif key == "indexes":
+                    for indexname in value.keys():
+                        lookups.append(('Search', ddoc_name, indexname))
+                elif key == "st_indexes":
+                    for geo in value.keys():
+                        lookups.append(('Geo', ddoc_name, geo))
+        p = ThreadPool(self.index_workers)
+        try:
+            index_sizes = dict(zip(lookups, p.map(self.get_index_size, lookups)))
+        except IOError as e:
+            sys.exit("Failed, bad HTTP response: {0}".format(e))
+        finally:
+            p.close()
         
         total_ddoc_sizes = dict(
             Views = 0,
@@ -258,22 +761,23 @@ class DBInfo(object):
         geoline = (" "*2)+'{0:5}: "{1}"  {2}'
         searchline = (" "*2)+'{0:5}: "{1}"  {2}'
         
-        print "Design documents:"
-        for row in json_response['rows']:
-            ddocurl = 'https://{0}.cloudant.com/{1}/{2}'.format(
-                self.account,
-                self.dbname,
-                row['key']
-                )
-            ddoc_content = self.json_get(ddocurl)
-
+        if self.out.table:
+            print "Design documents:"
+        for ddoc_content in ddocs:
             ddoc_name = re.sub('_design/', '', ddoc_content['_id'])
             ddoc_buffer = ' ' + ('-'*(50-len(ddoc_name)))
-            print ' "' + ddoc_name + '" ' + ddoc_buffer
+            if self.out.table:
+                print ' "' + ddoc_name + '" ' + ddoc_buffer
             
             for key,value in ddoc_content.items():
                 if (key == "views" and len(value) > 0):
-                    total_ddoc_sizes['Views'] = total_ddoc_sizes['Views'] + self.print_view_size(ddoc_name)
+                    view_size = index_sizes[('Views', ddoc_name, None)]
+                    total_ddoc_sizes['Views'] = total_ddoc_sizes['Views'] + view_size
+                    self.emit_index(ddoc_name, 'view', None, view_size)
+                    if not self.out.table:
+                        continue
+                    if view_size > 0:
+                        print '  Views: {0}'.format(self.data_size_pretty(view_size))
                     if (self.verbose):
                         for viewname,viewdata in value.items():
                             if ('reduce' in viewdata.keys() and 'options' in viewdata.keys()):
@@ -285,20 +789,52 @@ class DBInfo(object):
                             print viewline.format(viewtype,viewname)
                 elif key == "indexes":
                     for indexname in value.keys():
-                        search_size = self.get_search_size(ddoc_name,indexname)
+                        search_size = index_sizes[('Search', ddoc_name, indexname)]
                         total_ddoc_sizes['Search'] = total_ddoc_sizes['Search'] + search_size
-                        print searchline.format('Search Index',indexname, self.data_size_pretty(search_size))
+                        self.emit_index(ddoc_name, 'search', indexname, search_size)
+                        if self.out.table:
+                            print searchline.format('Search Index',indexname, self.data_size_pretty(search_size))
                 elif key == "st_indexes":
                     for geo in value.keys():
-                        geo_size = self.get_geo_size(ddoc_name,geo)
+                        geo_size = index_sizes[('Geo', ddoc_name, geo)]
                         total_ddoc_sizes['Geo'] = total_ddoc_sizes['Geo'] + geo_size
-                        print geoline.format('Geo Index',geo,self.data_size_pretty(geo_size))
+                        self.emit_index(ddoc_name, 'geo', geo, geo_size)
+                        if self.out.table:
+                            print geoline.format('Geo Index',geo,self.data_size_pretty(geo_size))
+        self.out.emit('index_totals', OrderedDict([
+            ('account', self.account),
+            ('db', self.dbname),
+            ('views', total_ddoc_sizes['Views']),
+            ('geo', total_ddoc_sizes['Geo']),
+            ('search', total_ddoc_sizes['Search'])
+        ]))
+        if not self.out.table:
+            return
         print ""
         print " Total index sizes across database:"
         for key,value in total_ddoc_sizes.items():
             print '{0:>7}: {1:>10}'.format(key,self.data_size_pretty(value))
         print ""
 
+    def emit_index(self, ddoc_name, index_type, name, size):
+        self.out.emit('index', OrderedDict([
+            ('account', self.account),
+            ('db', self.dbname),
+            ('ddoc', ddoc_name),
+            ('type', index_type),
+            ('name', name),
+            ('size', size)
+        ]))
+
+    def get_index_size(self, lookup):
+        indextype, ddoc, index = lookup
+        if indextype == 'Views':
+            return self.get_view_size(ddoc)
+        elif indextype == 'Search':
+            return self.get_search_size(ddoc, index)
+        else:
+            return self.get_geo_size(ddoc, index)
+
     def get_search_size(self, ddoc, index):
         myurl = 'https://{0}.cloudant.com/{1}/_design/{2}/_search_info/{3}'.format(
             self.account,
@@ -306,31 +842,29 @@ class DBInfo(object):
             ddoc,
             index
         )
-        search_info = self.json_get(myurl)
+        search_info = self.fetch_json(myurl)
         search_size = search_info['search_index']['disk_size']
         return search_size
 
     def get_geo_size(self, ddoc, index):
         myurl = 'https://{0}.cloudant.com/{1}/_design/{2}/_geo_info/{3}'.format(
-                self,account,
+                self.account,
                 self.dbname,
                 ddoc,
                 index
             )
-        geo_info = self.json_get(myurl)
+        geo_info = self.fetch_json(myurl)
         geo_size = geo_info['geo_index']['disk_size']
         return geo_size
 
-    def print_view_size(self, ddoc):
+    def get_view_size(self, ddoc):
         myurl = 'https://{0}.cloudant.com/{1}/_design/{2}/_info'.format(
                 self.account,
                 self.dbname,
                 ddoc
             )
-        view_info = self.json_get(myurl)
+        view_info = self.fetch_json(myurl)
         view_size = view_info['view_index']['sizes']['file']
-        if view_size > 0:
-            print '  Views: {0}'.format(self.data_size_pretty(view_size))
         return view_size
 
     def get_node_list(self):
@@ -339,7 +873,8 @@ class DBInfo(object):
         json_response = self.json_get(myurl)
         for nodestring in json_response['cluster_nodes']:
             nodes.append(self.strip_nodename(nodestring))
-        print " Distribution of shards for database "+ self.dbname +" on cluster: " + self.cluster
+        if self.out.table:
+            print " Distribution of shards for database "+ self.dbname +" on cluster: " + self.cluster
         self.print_shard_map(nodes, self.shards)
 
     def strip_nodename(self, fullname):
@@ -392,6 +927,15 @@ class DBInfo(object):
             lines_to_print.append([node, shardlist, len(distribution[node])])
             if width < len(shardlist):
                 width = len(shardlist)
+            self.out.emit('shard', OrderedDict([
+                ('cluster', self.cluster),
+                ('db', self.dbname),
+                ('node', 'db{0}'.format(node)),
+                ('shards', len(distribution[node])),
+                ('ranges', shardlist)
+            ]))
+        if not self.out.table:
+            return
         
         # Set format string up based on max shard column width
         formatstring = "|{0:>5} |{1:^6}|{2:<"+ str(width) + "}|"
@@ -409,7 +953,17 @@ def main():
 
     myargs = getargs()
     
-    dbinfo = DBInfo(myargs.account, myargs.database, myargs.v)
+    dbinfo = DBInfo(
+        myargs.account,
+        myargs.database,
+        myargs.v,
+        myargs.workers,
+        myargs.engine,
+        myargs.resume,
+        myargs.checkpoint,
+        myargs.reprobe,
+        myargs.format
+    )
     
     # Print summary data
     dbinfo.get_summary()
@@ -425,6 +979,8 @@ def main():
     # Get and print shard details
     if (myargs.s):
         dbinfo.get_node_list()
+
+    dbinfo.out.close()
         
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# Long-running Prometheus exporter for a Cloudant account
+# Keeps its connection pools and resolved cluster node list for the life of the process, and
+# refreshes account stats (as userdbs.py -u), active task summaries (as tasks.py) and node
+# disk usage (as cluster_disk.py) on their own schedules. Each refresh is rendered once,
+# and /metrics serves the latest rendering from memory.
+# Metric names are the same as those written by each tool's --format prom.
+
+import argparse, os, sys, time, threading
+import BaseHTTPServer, SocketServer
+import cloudant_client
+import cloudant_cache
+import cloudant_output
+import userdbs
+import tasks
+import cluster_disk
+from collections import OrderedDict
+
+config = dict(
+    account = '',
+    cluster = '',
+    my_header = dict(),
+    nodes = None, # Cluster node numbers, resolved on the first disk refresh
+    disk_timeout = 30,
+    lock = threading.Lock(),
+    snapshots = OrderedDict(), # Latest rendering of each collector
+    collectors = [],
+    rendered = '' # Everything served on /metrics
+)
+
+def getargs():
+    argparser = argparse.ArgumentParser(description = 'Serve Cloudant account, task and disk metrics to Prometheus')
+    argparser.add_argument(
+        'account',
+        type=str,
+        help='Cloudant DBaaS account name (https://<account>.cloudant.com)'
+        )
+    argparser.add_argument(
+        '--cluster',
+        help = 'Cloudant cluster name for disk metrics (default: the account name)',
+        type = str
+        )
+    argparser.add_argument(
+        '--port',
+        help = 'Port to serve /metrics on (default: 9314)',
+        type = int,
+        default = 9314
+        )
+    argparser.add_argument(
+        '--bind',
+        help = 'Address to serve /metrics on (default: 127.0.0.1)',
+        type = str,
+        default = '127.0.0.1'
+        )
+    argparser.add_argument(
+        '--userdbs-interval',
+        help = 'Seconds between account stats refreshes, 0 to disable (default: 300)',
+        type = int,
+        default = 300,
+        metavar = 'seconds'
+        )
+    argparser.add_argument(
+        '--tasks-interval',
+        help = 'Seconds between active task refreshes, 0 to disable (default: 30)',
+        type = int,
+        default = 30,
+        metavar = 'seconds'
+        )
+    argparser.add_argument(
+        '--disk-interval',
+        help = 'Seconds between node disk refreshes, 0 to disable (default: 60, needs CLOUDANT_ADMIN_AUTH)',
+        type = int,
+        default = 60,
+        metavar = 'seconds'
+        )
+    argparser.add_argument(
+        '--concurrency',
+        help = 'Number of database requests in flight at once during account refreshes (default: 16)',
+        type = int,
+        default = 16,
+        metavar = 'N'
+        )
+    return argparser.parse_args()
+
+def main():
+    myargs = getargs()
+    config['account'] = myargs.account
+    config['cluster'] = myargs.cluster or myargs.account
+
+    # Set authentication up
+    adminauthstring = os.environ.get('CLOUDANT_ADMIN_AUTH')
+    authstring = os.environ.get('CLOUDANT_AUTH')
+    if adminauthstring:
+        authstring = adminauthstring
+    elif not authstring:
+        sys.exit("ERROR: Required environment variables not set")
+    config['my_header'] = {'Content-Type': 'application/json', 'Authorization': authstring}
+    concurrency = max(myargs.concurrency, 1)
+    cloudant_client.configure(concurrency + 4)
+
+    if myargs.userdbs_interval > 0:
+        userdbs.config['account'] = myargs.account
+        userdbs.config['concurrency'] = concurrency
+        userdbs.config['my_header'] = config['my_header']
+        userdbs.config['cache'] = cloudant_cache.StatsCache()
+        config['collectors'].append(Collector('userdbs', myargs.userdbs_interval, collect_userdbs))
+    if myargs.tasks_interval > 0:
+        config['collectors'].append(Collector('tasks', myargs.tasks_interval, collect_tasks))
+    if myargs.disk_interval > 0:
+        if not adminauthstring:
+            sys.exit("ERROR: Disk metrics need CLOUDANT_ADMIN_AUTH, or use --disk-interval 0")
+        config['disk_timeout'] = min(myargs.disk_interval, 30)
+        config['collectors'].append(Collector('cluster_disk', myargs.disk_interval, collect_disk))
+    if len(config['collectors']) == 0:
+        sys.exit("ERROR: Every refresh is disabled, nothing to export")
+
+    server = MetricsServer((myargs.bind, myargs.port), MetricsHandler)
+    publish()
+    for collector in config['collectors']:
+        collector.start()
+    print " Serving metrics for {0} on http://{1}:{2}/metrics".format(myargs.account, myargs.bind, myargs.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def collect_userdbs(out):
+    # Incremental: only databases updated since the last refresh are queried
+    userdbs.config['output'] = out
+    userdbs.follow_updates()
+
+def collect_tasks(out):
+    args = argparse.Namespace(account = config['account'], d = False, heatmap = False, format = None)
+    tasks.CloudantActiveTasks(args, out, config['my_header']).get()
+
+def collect_disk(out):
+    if config['nodes'] is None:
+        config['nodes'] = cluster_disk.get_node_list(config['cluster'])
+    cluster_disk.get_disk_states(config['nodes'], config['disk_timeout'])
+    if len(cluster_disk.stale) > 0:
+        # A node may have been removed, so look the list up again next time
+        config['nodes'] = None
+    cluster_disk.config['output'] = out
+    cluster_disk.print_results()
+
+class Collector(threading.Thread):
+    # Runs one collect function every 'interval' seconds and publishes what it renders.
+    # A failed refresh keeps the previous rendering and is counted in the exporter's metrics.
+
+    def __init__(self, name, interval, collect):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        self.interval = interval
+        self.collect = collect
+        self.last_success = 0
+        self.duration = 0
+        self.errors = 0
+
+    def run(self):
+        while True:
+            start_time = time.time()
+            out = cloudant_output.BufferOutput(self.name)
+            try:
+                self.collect(out)
+                snapshot = out.getvalue()
+                self.last_success = time.time()
+            except (Exception, SystemExit) as e:
+                # The tools exit on errors, which must not end the refresh loop
+                snapshot = None
+                self.errors = self.errors + 1
+                sys.stderr.write(" {0} refresh failed: {1}\n".format(self.name, e))
+            self.duration = time.time() - start_time
+            publish(self.name, snapshot)
+            time.sleep(max(self.interval - self.duration, 0))
+
+def publish(name=None, snapshot=None):
+    # Rebuilds the /metrics body, so requests never wait on rendering
+    with config['lock']:
+        if snapshot is not None:
+            config['snapshots'][name] = snapshot
+        out = cloudant_output.BufferOutput('exporter')
+        for collector in config['collectors']:
+            out.emit('collector', OrderedDict([
+                ('collector', collector.name),
+                ('last_success', collector.last_success),
+                ('duration_seconds', round(collector.duration, 3)),
+                ('errors', collector.errors)
+            ]))
+        config['rendered'] = ''.join(config['snapshots'].values()) + out.getvalue()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, so scrapers don't reconnect every time
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = config['rendered']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if __name__ == "__main__":
+    main()
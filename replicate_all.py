@@ -3,30 +3,36 @@
 # This script will replicate all databases in a Cloudant account to another Cloudant account.
 # Use this for duplicating the entire content of an account to another location for testing purposes
 
-import requests,json,argparse,sys,getpass,os
+import json,argparse,sys,getpass,os,urllib
+import cloudant_client
 from base64 import b64encode
 
 from pprint import pprint
 
+# Replication documents written by this script are named <REPDOC_PREFIX><dbname>
+REPDOC_PREFIX = 'alldbs-'
 
 config = dict(
     header = dict(),
     sourceheader = '',
     destpass = '',
-    sourcepass = ''
+    sourcepass = '',
+    page_size = 10000 # Database names fetched per _all_dbs request
 )
 
 def main():
     myargs = get_args()
     set_auth(myargs)
     if myargs.t == False:
-        dblist = get_dbs(myargs)
+        dbcount = 0
         repcount = 0
-        for db in dblist:
+        for db in get_dbs(myargs):
+            dbcount = dbcount + 1
             if userdb(db):
                 replicate(db, myargs)
                 repcount = repcount + 1
-        print "{0} replication documents inserted. Use _active_tasks to check status.".format(repcount)
+        print "Total databases in account: {0}".format(dbcount)
+        print "{0} replication documents inserted. Use 'tasks.py --replications {1}' to check status.".format(repcount, myargs.source)
         print "To signal stop of replication tasks, run script again with -t option."
     else:
         terminate_tasks(myargs)
@@ -83,8 +89,8 @@ def replicate(db, myargs):
         ),
         "create_target": not myargs.e,
         "continuous": myargs.c,
-        "name": "alldbs-{0}".format(db),
-        "_id": "alldbs-{0}".format(db)
+        "name": REPDOC_PREFIX + db,
+        "_id": REPDOC_PREFIX + db
     }
     pprint(repdoc)
     repdburl = "https://{0}.cloudant.com/_replicator".format(myargs.source)
@@ -102,14 +108,26 @@ def set_auth(myargs):
     config['destpass'] = getpass.getpass()
     
 def get_dbs(myargs):
-    myurl = "https://{0}.cloudant.com/_all_dbs".format(myargs.source)
-    dbjson = http_get(myurl, config['sourceheader'])
-    print "Total databases in account: {0}".format(len(dbjson))
-    return(dbjson)
+    # Yields every database name in the source account, one _all_dbs page at a time
+    myurl = "https://{0}.cloudant.com/_all_dbs?limit={1}".format(myargs.source, config['page_size'])
+    last_db = None
+    while True:
+        if last_db is None:
+            dbjson = http_get(myurl, config['sourceheader'])
+        else:
+            dbjson = http_get(
+                "{0}&skip=1&startkey={1}".format(myurl, urllib.quote(json.dumps(last_db))),
+                config['sourceheader']
+            )
+        for db in dbjson:
+            yield db
+        if len(dbjson) < config['page_size']:
+            return
+        last_db = dbjson[-1]
 
 def http_get(url, header):
     try:
-        r = requests.get(
+        r = cloudant_client.get(
             url,
             headers = header
         )
@@ -121,7 +139,7 @@ def http_get(url, header):
 
 def http_delete(url, header):
     try:
-        r = requests.delete(
+        r = cloudant_client.delete(
             url,
             headers = header
         )
@@ -133,7 +151,7 @@ def http_delete(url, header):
     
 def http_post(url, header, content):
     try:
-        r = requests.post(
+        r = cloudant_client.post(
             url,
             headers = header,
             data = content
@@ -150,7 +168,7 @@ def terminate_tasks(myargs):
     repdocs = http_get(myurl, config['sourceheader'])
     for repdoc in repdocs['rows']:
         # if it's one of this script's replication docs, delete it
-        m = re.search('alldbs-', repdoc['id'])
+        m = re.search(REPDOC_PREFIX, repdoc['id'])
         if m:
             myurl = "https://{0}.cloudant.com/_replicator/{1}?rev={2}".format(
                 myargs.source,
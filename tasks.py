@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
-import argparse, requests, json, os, sys
+import argparse, json, os, sys, time, urllib
+import numpy as np
+import cloudant_client
+import cloudant_output
+import replicate_all
+from collections import OrderedDict
 
 def getargs():
     argparser = argparse.ArgumentParser(description = 'Display the status of all tasks running on a Cloudant account')
@@ -14,25 +19,197 @@ def getargs():
         action='store_true',
         help='Display detailed information about tasks'
     )
+    argparser.add_argument(
+        '--watch',
+        type=float,
+        metavar='N',
+        help='Poll every N seconds, showing the rate and ETA of each task (Ctrl-C to stop)'
+    )
+    argparser.add_argument(
+        '--heatmap',
+        action='store_true',
+        help='Show pending indexing changes by database and shard range, and by node'
+    )
+    argparser.add_argument(
+        '--replications',
+        action='store_true',
+        help='Track the replications started by replicate_all.py: samples _active_tasks to show each database\'s throughput, lag and stalled tasks'
+    )
+    argparser.add_argument(
+        '--samples',
+        type=int,
+        default=3,
+        metavar='N',
+        help='Number of _active_tasks samples taken with --replications (default: 3)'
+    )
+    argparser.add_argument(
+        '--interval',
+        type=float,
+        default=10,
+        metavar='seconds',
+        help='Seconds between --replications samples (default: 10)'
+    )
+    cloudant_output.add_argument(argparser)
     return argparser.parse_args()
 
 def main():
-    activetasks = CloudantActiveTasks(getargs())
-    activetasks.get()
+    args = getargs()
+    activetasks = CloudantActiveTasks(args)
+    if args.replications:
+        activetasks.replications(max(args.samples, 2), args.interval)
+    elif args.watch:
+        try:
+            activetasks.watch(max(args.watch, 0.5))
+        except KeyboardInterrupt:
+            pass
+    else:
+        activetasks.get()
+    activetasks.out.close()
+
+class Task(object):
+    # One entry from _active_tasks, reduced to the fields the reports use.
+    # key identifies the task across polls. done counts the changes processed so far.
+    # index names the search index, as one design document can hold several.
+    __slots__ = ('type', 'key', 'database', 'shard_range', 'ddoc', 'index', 'label', 'pending', 'done', 'progress', 'continuous', 'node')
+
+    def __init__(self, type, key, database, shard_range=None, ddoc=None, label=None, pending=0, done=0, progress=None, continuous=None, node=None, index=None):
+        self.type = type
+        self.key = key
+        self.database = database
+        self.shard_range = shard_range
+        self.ddoc = ddoc
+        self.index = index
+        self.label = label or database
+        self.pending = pending
+        self.done = done
+        self.progress = progress
+        self.continuous = continuous
+        self.node = node
+
+class TaskGroup(object):
+    # Running totals for the tasks on one database and design document
+    __slots__ = ('database', 'ddoc', 'tasks', 'pending', 'done')
+
+    def __init__(self, database, ddoc):
+        self.database = database
+        self.ddoc = ddoc
+        self.tasks = 0
+        self.pending = 0
+        self.done = 0
+
+    def add(self, task):
+        self.tasks = self.tasks + 1
+        self.pending = self.pending + task.pending
+        self.done = self.done + task.done
+
+def parse_replication(task, shard_names):
+    # database is the last part of the source URL, which may not be a local database,
+    # so replications are left out of the database and design document groups
+    database = task.get('source', '').rstrip('/').rsplit('/', 1)[-1] or task['replication_id']
+    return Task(
+        'replication',
+        task['replication_id'],
+        database,
+        label = task['replication_id'],
+        pending = task['changes_pending'],
+        # revisions_checked counts every change read from the source
+        done = task.get('revisions_checked', task.get('docs_read', 0)),
+        continuous = task['continuous']
+    )
+
+def parse_indexer(task, shard_names):
+    # indexer and search_indexer
+    database, shard_range = split_shard(task['database'], shard_names)
+    ddoc = task['design_document'][8:] # Drop '_design/'
+    index = task.get('index') # search_indexer only
+    node = node_name(task.get('node'))
+    return Task(
+        task['type'],
+        (task['type'], task['database'], ddoc, index, replica(task, node)),
+        database,
+        shard_range,
+        ddoc,
+        ' '.join([database, shard_range[:8], ddoc] + ([index] if index else []) + ([node] if node else [])),
+        task['total_changes'] - task['changes_done'],
+        task['changes_done'],
+        task.get('progress'),
+        node = node,
+        index = index
+    )
+
+def parse_compaction(task, shard_names):
+    # database_compaction and view_compaction, and any other task that reports changes
+    database, shard_range = split_shard(task['database'], shard_names)
+    ddoc = task.get('design_document')
+    if ddoc is not None:
+        ddoc = ddoc[8:]
+    node = node_name(task.get('node'))
+    return Task(
+        task['type'],
+        (task['type'], task['database'], ddoc, replica(task, node)),
+        database,
+        shard_range,
+        ddoc,
+        ' '.join([database, shard_range[:8]] + ([ddoc] if ddoc else []) + ([node] if node else [])),
+        task.get('total_changes', 0) - task.get('changes_done', 0),
+        task.get('changes_done', 0),
+        task.get('progress'),
+        node = node
+    )
+
+parsers = dict(
+    replication = parse_replication,
+    indexer = parse_indexer,
+    search_indexer = parse_indexer,
+    view_compaction = parse_compaction,
+    database_compaction = parse_compaction
+)
+
+def split_shard(shard, shard_names):
+    # 'shards/<range>/<user>/<db>.<timestamp>' to (db, range). Every task on a shard
+    # names it the same way, so each shard is only split once per pass.
+    names = shard_names.get(shard)
+    if names is None:
+        shards,shard_range,username,database_and_time = shard.split('/')
+        names = (database_and_time.split('.')[0], shard_range)
+        shard_names[shard] = names
+    return names
+
+def replica(task, node):
+    # Every replica of a shard runs its own indexers and compactions under the same
+    # shard name, so the node (or, without one, the process) tells them apart
+    if node is not None:
+        return node
+    return task.get('pid')
+
+def node_name(node):
+    # 'dbcore@db1.<cluster>.cloudant.net' to 'db1'
+    if node is None:
+        return None
+    return node.split('@')[-1].split('.')[0]
 
 class CloudantActiveTasks(object):
     
-    def __init__(self, args):
+    def __init__(self, args, out=None, my_header=None):
+        # out replaces the output given by args.format, e.g. exporter.py's in-memory output,
+        # and my_header the auth header read from the environment
         self.account = args.account
         self.detail = args.d
-        adminauthstring = os.environ.get('CLOUDANT_ADMIN_AUTH')
-        authstring = os.environ.get('CLOUDANT_AUTH')
-        if len(adminauthstring) > 0:
-            authstring = adminauthstring
-        elif len(authstring) == 0:
-            sys.exit("ERROR: Required environment variables not set")
-        self.my_header = {'Content-Type': 'application/json', 'Authorization': authstring}
+        self.heatmap = args.heatmap
+        self.out = out or cloudant_output.Output(args.format, 'tasks')
+        if my_header is None:
+            adminauthstring = os.environ.get('CLOUDANT_ADMIN_AUTH')
+            authstring = os.environ.get('CLOUDANT_AUTH')
+            if adminauthstring:
+                authstring = adminauthstring
+            elif not authstring:
+                sys.exit("ERROR: Required environment variables not set")
+            my_header = {'Content-Type': 'application/json', 'Authorization': authstring}
+        self.my_header = my_header
         self.tasks_raw = []
+        # Last poll time and changes done for each task seen by watch(), keyed by task identity
+        self.samples = dict()
+        self.shard_names = dict()
         self.types = dict(
             indexer = 0,
             replication = 0,
@@ -40,87 +217,408 @@ class CloudantActiveTasks(object):
             view_compaction = 0,
             database_compaction = 0,
         )
-        self.grouped_tasks = dict(
-            replication = dict(),
-            indexer = dict(),
-            search_indexer = dict(),
-            view_compaction = dict(),
-            database_compaction = dict()
-            )
-        
-    def get_new(self): # unfinished
-        for task in self.tasks_raw:
-            thistype = task['type']
-            if thistype == 'indexer':
-                shards,shard_range,username,database_and_time = task['database'].split('/')
-                ddoc = task['design_document'].split('/')[1]
-                pending = task['total_changes'] - task['changes_done']
-                self.append_task(
-                    [
-                        thistype,
-                        database_and_time.split('.')[0],
-                        ddoc,
-                        shard_range,
-                        pending
-                    ]
-                )
-            elif thistype == 'search_indexer':
-                pass
-            elif thistype == 'replication':
-                pass
-            elif thistype == 'view_compaction':
-                pass
-            elif thistype == 'database_compaction':
-                pass
-            
+        # TaskGroup for each (database, design document), for every task but replications
+        self.grouped_tasks = dict()
+        # Indexing tasks, kept for the heatmap
+        self.index_tasks = []
+        self.heatmap_rows = 20
+        self.heat_levels = ' .:-=+*#%@'
+        self.page_size = 1000 # _replicator docs fetched per request
+
+    def parse(self, task):
+        return parsers.get(task['type'], parse_compaction)(task, self.shard_names)
     
     def get(self):
+        # Parses, prints and totals every task in a single pass
         myurl = 'https://{0}.cloudant.com/_active_tasks'.format(self.account)
         self.tasks_raw = self.json_get(myurl)
-        print " Active tasks for account " + self.account
-        for task in self.tasks_raw:
-            if task['type'] == 'replication':
-                pending = task['changes_pending']
-                if task['continuous']:
-                    cont = 'Continuous'
-                else:
-                    cont = 'One-time'
-                if self.detail:
+        if self.out.table:
+            print " Active tasks for account " + self.account
+        for raw in self.tasks_raw:
+            task = self.parse(raw)
+            # Every task gets the same fields, None where they don't apply, so CSV
+            # output has one header for all of them
+            record = OrderedDict([
+                ('account', self.account),
+                ('type', task.type),
+                ('replication_id', None),
+                ('continuous', None),
+                ('database', None),
+                ('shard_range', None),
+                ('ddoc', None),
+                ('index', None),
+                ('node', task.node), # Replicas of a shard differ only by node
+                ('progress', None),
+                ('pending', task.pending)
+            ])
+            if task.type == 'replication':
+                if self.detail and self.out.table:
+                    if task.continuous:
+                        cont = 'Continuous'
+                    else:
+                        cont = 'One-time'
                     print " {0} replication: {1}\n   Pending: {2}".format(
                         cont,
-                        task['replication_id'],
-                        pending
+                        task.key,
+                        task.pending
                     )
-            elif 'indexer' in task['type']:    
-                shards,shard_range,username,database_and_time = task['database'].split('/')
-                ddoc = task['design_document'].split('/')[1]
-                pending = task['total_changes'] - task['changes_done']
-                if self.detail:
+                record['replication_id'] = task.key
+                record['continuous'] = task.continuous
+            elif 'indexer' in task.type:
+                if self.detail and self.out.table:
                     print " {0} {1} {2} {3} {4}%".format(
-                        database_and_time.split('.')[0],
-                        shard_range[:4],
-                        task['type'],
-                        ddoc,
-                        task['progress']
+                        task.database,
+                        task.shard_range[:4],
+                        task.type,
+                        task.ddoc if task.index is None else '{0}/{1}'.format(task.ddoc, task.index),
+                        task.progress
                     )
+                record['database'] = task.database
+                record['shard_range'] = task.shard_range
+                record['ddoc'] = task.ddoc
+                record['index'] = task.index
+                record['progress'] = task.progress
+                if self.heatmap:
+                    self.index_tasks.append(task)
             else:
-                shards,shard_range,username,database_and_time = task['database'].split('/')
-                pending = task['total_changes'] - task['changes_done']
-                if self.detail:
+                if self.detail and self.out.table:
                     print " {0} {1} {2} Pending: {3}".format(
-                        database_and_time.split('.')[0],
-                        shard_range[:4],
-                        task['type'],
-                        pending
+                        task.database,
+                        task.shard_range[:4],
+                        task.type,
+                        task.pending
                     )
+                record['database'] = task.database
+                record['shard_range'] = task.shard_range
+                record['ddoc'] = task.ddoc
+            self.out.emit('task', record)
             
-            self.types[task['type']] = self.types[task['type']] + pending
-        print " Total changes left:"
+            self.types[task.type] = self.types.get(task.type, 0) + task.pending
+            if task.type == 'replication':
+                continue
+            group = self.grouped_tasks.get((task.database, task.ddoc))
+            if group is None:
+                group = TaskGroup(task.database, task.ddoc)
+                self.grouped_tasks[(task.database, task.ddoc)] = group
+            group.add(task)
+        self.print_groups()
+        if self.heatmap:
+            self.print_heatmap()
+        if self.out.table:
+            print " Total changes left:"
         for summary in self.types.keys():
-            print " {0}: {1}".format(summary, self.types[summary])
+            if self.out.table:
+                print " {0}: {1}".format(summary, self.types[summary])
+            self.out.emit('pending', OrderedDict([
+                ('account', self.account),
+                ('type', summary),
+                ('changes', self.types[summary])
+            ]))
+
+    def print_groups(self):
+        # Busiest databases and design documents first
+        groups = sorted(self.grouped_tasks.values(), key=lambda group: group.pending, reverse=True)
+        if self.out.table and len(groups) > 0:
+            print " Changes left by database and design document:"
+        for group in groups:
+            if self.out.table:
+                print " {0:<40} {1:<30} {2:>6} tasks {3:>12} pending".format(
+                    group.database,
+                    group.ddoc or '',
+                    group.tasks,
+                    group.pending
+                )
+            self.out.emit('group', OrderedDict([
+                ('account', self.account),
+                ('database', group.database),
+                ('ddoc', group.ddoc),
+                ('tasks', group.tasks),
+                ('pending', group.pending),
+                ('done', group.done)
+            ]))
+
+    def print_heatmap(self):
+        # Pending indexing changes summed by database x shard range and by node.
+        # Tasks are turned into index arrays once, then summed with bincount.
+        tasks = self.index_tasks
+        if len(tasks) == 0:
+            if self.out.table:
+                print " No indexing tasks running"
+            return
+        pending = np.array([task.pending for task in tasks], dtype=np.int64)
+        dbs, db_index = np.unique([task.database for task in tasks], return_inverse=True)
+        ranges, range_index = np.unique([task.shard_range for task in tasks], return_inverse=True)
+        heat = np.bincount(
+            db_index * len(ranges) + range_index,
+            weights = pending,
+            minlength = len(dbs) * len(ranges)
+        ).astype(np.int64).reshape(len(dbs), len(ranges))
+        db_totals = heat.sum(axis=1)
+        hottest = np.argsort(db_totals)[::-1][:self.heatmap_rows]
+        for row in hottest:
+            for column in np.nonzero(heat[row])[0]:
+                self.out.emit('heat', OrderedDict([
+                    ('account', self.account),
+                    ('database', dbs[row]),
+                    ('shard_range', ranges[column]),
+                    ('pending', int(heat[row, column]))
+                ]))
+        if self.out.table:
+            # Each cell is one shard range, shaded relative to the busiest cell
+            levels = np.ceil(heat[hottest] * (len(self.heat_levels) - 1.0) / max(heat.max(), 1)).astype(int)
+            width = max(len(dbs[row]) for row in hottest)
+            print ""
+            print " Pending indexing changes by database and shard range ('{0}' = {1} changes)".format(
+                self.heat_levels[-1],
+                heat.max()
+            )
+            print " {0:<{1}} |{2}| {3:>12}".format('', width, ''.join(shard_range[0] for shard_range in ranges), 'Pending')
+            for line, row in enumerate(hottest):
+                print " {0:<{1}} |{2}| {3:>12}".format(
+                    dbs[row],
+                    width,
+                    ''.join(self.heat_levels[level] for level in levels[line]),
+                    db_totals[row]
+                )
+            if len(dbs) > self.heatmap_rows:
+                print " ... and {0} more databases".format(len(dbs) - self.heatmap_rows)
+
+        # _active_tasks only names the node on some clusters
+        located = [i for i, task in enumerate(tasks) if task.node is not None]
+        if len(located) == 0:
+            if self.out.table:
+                print " Tasks don't report their node, so there is no per-node view"
+            return
+        nodes, node_index = np.unique([tasks[i].node for i in located], return_inverse=True)
+        node_pending = np.bincount(node_index, weights=pending[located], minlength=len(nodes)).astype(np.int64)
+        node_tasks = np.bincount(node_index, minlength=len(nodes))
+        share = node_pending * 100.0 / max(node_pending.sum(), 1)
+        if self.out.table:
+            print ""
+            print " Pending indexing changes by node:"
+        for i in np.argsort(node_pending)[::-1]:
+            self.out.emit('node', OrderedDict([
+                ('account', self.account),
+                ('node', nodes[i]),
+                ('tasks', int(node_tasks[i])),
+                ('pending', int(node_pending[i]))
+            ]))
+            if self.out.table:
+                print " {0:>6} {1:>5} tasks {2:>12} pending {3:5.1f}% {4}".format(
+                    nodes[i],
+                    node_tasks[i],
+                    node_pending[i],
+                    share[i],
+                    '#' * int(round(share[i] * 0.4))
+                )
+
+    def replications(self, samples, interval):
+        # Joins the _replicator docs written by replicate_all.py with their _active_tasks
+        # entries over several samples, to find replications that are falling behind
+        repdocs = self.get_repdocs()
+        by_replication_id = dict()
+        for db, doc in repdocs.iteritems():
+            if '_replication_id' in doc:
+                by_replication_id[doc['_replication_id']] = db
+        # [first time, first done, first pending, last time, last done, last pending] per database
+        history = dict()
+        myurl = 'https://{0}.cloudant.com/_active_tasks'.format(self.account)
+        for sample in range(samples):
+            if sample > 0:
+                time.sleep(interval)
+            if self.out.table:
+                sys.stdout.write("\r Sampling _active_tasks {0} of {1}".format(sample + 1, samples))
+                sys.stdout.flush()
+            now = time.time()
+            for raw in self.json_get(myurl):
+                if raw['type'] != 'replication':
+                    continue
+                doc_id = raw.get('doc_id') or ''
+                if doc_id.startswith(replicate_all.REPDOC_PREFIX):
+                    db = doc_id[len(replicate_all.REPDOC_PREFIX):]
+                else:
+                    # Replication IDs carry options after a '+', e.g. '<id>+continuous'
+                    db = by_replication_id.get(raw['replication_id'].split('+')[0])
+                    if db is None:
+                        continue
+                task = parse_replication(raw, self.shard_names)
+                entry = history.get(db)
+                if entry is None:
+                    history[db] = [now, task.done, task.pending, now, task.done, task.pending]
+                else:
+                    entry[3] = now
+                    entry[4] = task.done
+                    entry[5] = task.pending
+        if self.out.table:
+            print ""
+
+        rows = []
+        for db, doc in repdocs.iteritems():
+            entry = history.get(db)
+            state = doc.get('_replication_state', 'new')
+            throughput = None
+            pending = None
+            growth = None
+            eta = None
+            if entry is not None:
+                pending = entry[5]
+                growth = entry[5] - entry[2]
+                if entry[3] > entry[0]:
+                    throughput = (entry[4] - entry[1]) / (entry[3] - entry[0])
+                if throughput > 0:
+                    eta = pending / throughput
+                if throughput is None:
+                    status = 'running'
+                elif throughput == 0 and pending > 0:
+                    status = 'stalled'
+                elif growth > 0:
+                    status = 'behind'
+                else:
+                    status = 'ok'
+            elif state == 'error':
+                status = 'error'
+            elif state == 'completed':
+                status = 'completed'
+            else:
+                # Triggered (or waiting to be) but not running
+                status = 'no task'
+            rows.append((db, state, status, pending, throughput, growth, eta))
+
+        # Problems first, then the largest lag
+        severity = {'stalled': 0, 'error': 1, 'no task': 2, 'behind': 3, 'running': 4, 'ok': 5, 'completed': 6}
+        rows.sort(key=lambda row: (severity[row[2]], -(row[3] or 0)))
+        counts = dict()
+        lineformat = " {0:<40} {1:<10} {2:<10} {3:>12} {4:>10} {5:>10} {6:>14}"
+        if self.out.table:
+            print " Replications started by replicate_all.py on {0}, sampled {1} times over {2}s".format(
+                self.account,
+                samples,
+                int(interval * (samples - 1))
+            )
+            print lineformat.format('Database', 'State', 'Status', 'Pending', 'Changes/s', 'Growth', 'ETA')
+        for db, state, status, pending, throughput, growth, eta in rows:
+            counts[status] = counts.get(status, 0) + 1
+            self.out.emit('replication', OrderedDict([
+                ('account', self.account),
+                ('database', db),
+                ('state', state),
+                ('status', status),
+                ('pending', pending),
+                ('throughput', None if throughput is None else round(throughput, 1)),
+                ('pending_growth', growth),
+                ('eta_seconds', None if eta is None else int(eta))
+            ]))
+            # Healthy replications are only listed with -d
+            if self.out.table and (self.detail or status not in ('ok', 'completed')):
+                print lineformat.format(
+                    db[:40],
+                    state,
+                    status,
+                    '-' if pending is None else pending,
+                    '-' if throughput is None else round(throughput, 1),
+                    '-' if growth is None else growth,
+                    '-' if eta is None else self.pretty_time(eta)
+                )
+        if self.out.table:
+            print " " + ", ".join("{0} {1}".format(counts[status], status) for status in sorted(counts, key=severity.get))
+
+    def get_repdocs(self):
+        # Returns the replicate_all.py documents in _replicator, keyed by database name
+        prefix = replicate_all.REPDOC_PREFIX
+        myurl = 'https://{0}.cloudant.com/_replicator/_all_docs?include_docs=true&limit={1}&endkey={2}'.format(
+            self.account,
+            self.page_size,
+            urllib.quote(json.dumps(prefix + u'\ufff0'))
+        )
+        startkey = prefix
+        skip = 0
+        repdocs = dict()
+        while True:
+            page = self.json_get('{0}&skip={1}&startkey={2}'.format(
+                myurl,
+                skip,
+                urllib.quote(json.dumps(startkey))
+            ))
+            for row in page['rows']:
+                repdocs[row['id'][len(prefix):]] = row['doc']
+            if len(page['rows']) < self.page_size:
+                return repdocs
+            startkey = page['rows'][-1]['id']
+            skip = 1
+
+    def watch(self, interval):
+        # Polls _active_tasks every 'interval' seconds. Each task's rate comes from the
+        # changes it processed since the previous poll, so a task shows its rate and ETA
+        # from the second poll it appears in.
+        myurl = 'https://{0}.cloudant.com/_active_tasks'.format(self.account)
+        lineformat = " {0:<20} {1:<50} {2:>12} {3:>10} {4:>14}\033[K\n"
+        if self.out.table:
+            sys.stdout.write("\033[2J")
+        while True:
+            start_time = time.time()
+            self.tasks_raw = self.json_get(myurl)
+            now = time.time()
+            if self.out.table:
+                sys.stdout.write("\033[H")
+                sys.stdout.write(" Active tasks for account {0}, every {1}s ({2})\033[K\n\033[K\n".format(
+                    self.account,
+                    interval,
+                    time.strftime('%H:%M:%S')
+                ))
+                sys.stdout.write(lineformat.format('Type', 'Task', 'Pending', 'Changes/s', 'ETA'))
+            seen = set()
+            for raw in sorted(self.tasks_raw, key=lambda raw: raw['type']):
+                task = self.parse(raw)
+                key, label, pending, done = task.key, task.label, task.pending, task.done
+                seen.add(key)
+                sample = self.samples.get(key)
+                rate = None
+                if sample is None:
+                    self.samples[key] = [now, done]
+                else:
+                    if now > sample[0]:
+                        rate = (done - sample[1]) / (now - sample[0])
+                    sample[0] = now
+                    sample[1] = done
+                if rate is not None and rate > 0:
+                    eta = pending / rate
+                else:
+                    eta = None
+                self.out.emit('task', OrderedDict([
+                    ('account', self.account),
+                    ('type', task.type),
+                    ('task', label),
+                    ('pending', pending),
+                    ('rate', None if rate is None else round(rate, 1)),
+                    ('eta_seconds', None if eta is None else int(eta))
+                ]))
+                if self.out.table:
+                    sys.stdout.write(lineformat.format(
+                        task.type,
+                        label[:50],
+                        pending,
+                        '-' if rate is None else round(rate, 1),
+                        '-' if eta is None else self.pretty_time(eta)
+                    ))
+            # Forget finished tasks
+            for key in self.samples.keys():
+                if key not in seen:
+                    del self.samples[key]
+            if self.out.table:
+                sys.stdout.write("\033[J")
+                sys.stdout.flush()
+            time.sleep(max(interval - (time.time() - start_time), 0))
+
+    def pretty_time(self, seconds):
+        seconds = float(seconds)
+        if seconds >= 3600:
+            return "{0} hours".format(round(seconds / 3600, 1))
+        elif seconds >= 60:
+            return "{0} min".format(round(seconds / 60, 1))
+        return "{0} s".format(int(seconds))
     
     def json_get(self, url):
-        r = requests.get(
+        r = cloudant_client.get(
             url,
             headers = self.my_header
         )
@@ -1,19 +1,37 @@
 #!/usr/bin/env python
-import requests
+import cloudant_client
 import json
 import sys
 import argparse
 import os
 import string
 import locale
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import time
+import threading
+import urllib
+import itertools
+import Queue
+import cloudant_cache
+import cloudant_output
+from collections import OrderedDict, deque
 
 config = dict(
     my_header = dict(),
     account = '',
     maxdbs = 40,
+    concurrency = 64,
+    progress_interval = 0.5,
+    pool = None,
+    cache = None,
+    output = None,
+    refresh = False,
+    ttl = 3600,
+    cache_hits = 0,
+    updates_batch = 1000,
+    page_size = 10000, # Database names fetched per _all_dbs request
+    lock = threading.Lock(),
     summary_only = False,
     force_list = False,  
     totals = dict(
@@ -39,9 +57,40 @@ def main(argv):
         help = 'Force list of databases, even if there are over {0}'.format(config['maxdbs']),
         action = 'store_true'
         )
+    argparser.add_argument(
+        '--concurrency',
+        help = 'Number of database requests in flight at once (default: {0})'.format(config['concurrency']),
+        type = int,
+        default = config['concurrency'],
+        metavar = 'N'
+        )
+    argparser.add_argument(
+        '-r',
+        help = 'Use stats cached by earlier runs, only querying databases whose entry has expired',
+        action = 'store_true'
+        )
+    argparser.add_argument(
+        '--ttl',
+        help = 'Seconds before cached database stats expire with -r (default: {0})'.format(config['ttl']),
+        type = int,
+        default = config['ttl'],
+        metavar = 'seconds'
+        )
+    argparser.add_argument(
+        '-u',
+        help = 'Only query databases created or updated since the last -u run (follows _db_updates) and print account totals',
+        action = 'store_true'
+        )
+    cloudant_output.add_argument(argparser)
     myargs = argparser.parse_args()
     config['account'] = myargs.account
     config['force_list'] = myargs.f
+    config['concurrency'] = max(myargs.concurrency, 1)
+    config['refresh'] = myargs.r
+    config['ttl'] = myargs.ttl
+    cloudant_client.configure(config['concurrency'])
+    config['cache'] = cloudant_cache.StatsCache()
+    config['output'] = cloudant_output.Output(myargs.format, 'userdbs')
 
     # Set authentication up        
     adminauthstring = os.environ.get('CLOUDANT_ADMIN_AUTH')
@@ -51,32 +100,47 @@ def main(argv):
     elif len(authstring) == 0:
         sys.exit("ERROR: Required environment variables not set")
     config['my_header'] = {'Content-Type': 'application/json', 'Authorization': authstring}
+
+    if myargs.u:
+        follow_updates()
+        config['cache'].close()
+        config['output'].close()
+        return
     
-    # Get list of databases for the account
-    myurl = 'https://{0}.cloudant.com/_all_dbs'.format(config['account'])
-    dbs = http_request(myurl)
-    config['dbcount'] = len(dbs)
+    # Count the databases in the account and find the longest name. Names are streamed
+    # page by page here and again below, so the full list is never held in memory.
+    config['dbcount'] = 0
+    dblen = 10
+    for db in iter_all_dbs():
+        config['dbcount'] = config['dbcount'] + 1
+        dblen = max(dblen, len(db))
     
     # If the total number of databases is greater than 40 and user forces details
+    # (The results gathered for the estimate are kept and not queried again)
     if (config['dbcount'] > config['maxdbs']) and config['force_list']:
-        give_estimate(dbs,True)
-        detail_table(dbs)
+        sample, last_db = give_estimate(True)
+        detail_table(iter_all_dbs(last_db), dblen, sample)
         
     # If dbcount > 40 and user doesn't force, build and print a summary    
     elif (config['dbcount'] > config['maxdbs']) and not config['force_list']:
-        give_estimate(dbs,False)
-        summary(dbs)
+        sample, last_db = give_estimate(False)
+        summary(iter_all_dbs(last_db), sample)
         
     # Otherwise, default to printing detail table    
     else:
-        detail_table(dbs)
+        detail_table(iter_all_dbs(), dblen)
 
-def detail_table(dbs):
-    # Figure out width of db name field
-    dblen = 10
-    for db in dbs:
-        if len(db) > dblen:
-            dblen = len(db)
+    if config['refresh'] and config['output'].table:
+        print " {0} of {1} databases served from cache".format(
+            count_pretty(config['cache_hits']),
+            count_pretty(config['dbcount'])
+        )
+    config['cache'].close()
+    config['output'].close()
+
+def detail_table(dbs, dblen, sample=[]):
+    # dbs yields the databases not already queried for the sample, and dblen is the
+    # width of the db name field
             
     # Define formatting for table
     headerformat = "|{0:^" + str(dblen) + "}|{1:^4}|{2:^3}|{3:^10}|{4:^11}|{5:^14} |{6:^14} |"
@@ -92,34 +156,42 @@ def detail_table(dbs):
     )
     width = len(headline)
     
-    # Open a multi-process pool with CPU count processes
-    p = Pool()
-    # Get details of each database
-    results_array = p.map(get_details, dbs)
-
     # Begin printing table    
-    print "_" * width
-    
-    print headline
-    
-    print "-" * width    
-
-    # Print each database's details and add to totals
-    for result in results_array:
-        print summaryline.format(
-            result['db'],
-            result['shardcount'],
-            result['nvalue'],
-            data_size_pretty(result['active']),
-            data_size_pretty(result['disk']),
-            count_pretty(result['doc_count']),
-            count_pretty(result['del_doc_count'])
-        )
+    if config['output'].table:
+        print "_" * width
+        
+        print headline
+        
+        print "-" * width    
+
+    # Print each database's details as they arrive and add to totals. Rows start by
+    # clearing the live progress line, if there is one.
+    if sys.stderr.isatty():
+        rowstart = "\r\033[K"
+    else:
+        rowstart = ""
+    remaining = pool_results(get_details, dbs, config['dbcount'] - len(sample), len(sample))
+    for result in itertools.chain(sample, remaining):
+        if config['output'].table:
+            print rowstart + summaryline.format(
+                result['db'],
+                result['shardcount'],
+                result['nvalue'],
+                data_size_pretty(result['active']),
+                data_size_pretty(result['disk']),
+                count_pretty(result['doc_count']),
+                count_pretty(result['del_doc_count'])
+            )
+        emit_database(result['db'], result)
         
         for key, value in result.iteritems():
             if key != 'db':
                 config['totals'][key] = config['totals'][key] + value
       
+    emit_account(config['dbcount'], config['totals'])
+    if not config['output'].table:
+        return
+
     print "-" * width
     
     print summaryline.format(
@@ -134,107 +206,295 @@ def detail_table(dbs):
     
     print "-" * width
 
-def give_estimate(dbs, detail):
-    p = Pool()
-    # Sample set is the first 'maxdbs' of databases
-    sub_array = dbs[0:config['maxdbs']]
+def emit_database(db, stats):
+    config['output'].emit('database', OrderedDict([
+        ('account', config['account']),
+        ('db', db),
+        ('shardcount', stats.get('shardcount')),
+        ('nvalue', stats.get('nvalue')),
+        ('doc_count', stats['doc_count']),
+        ('del_doc_count', stats['del_doc_count']),
+        ('active', stats['active']),
+        ('disk', stats['disk'])
+    ]))
+
+def emit_account(dbcount, totals):
+    config['output'].emit('account', OrderedDict([
+        ('account', config['account']),
+        ('dbs', int(dbcount)),
+        ('doc_count', int(totals['doc_count'])),
+        ('del_doc_count', int(totals['del_doc_count'])),
+        ('active', int(totals['active'])),
+        ('disk', int(totals['disk']))
+    ]))
+
+def give_estimate(detail):
+    # Sample set is the first 'maxdbs' of databases. Returns their results and the last
+    # name sampled, which the full listing resumes after.
+    sub_array = list(itertools.islice(iter_all_dbs(), config['maxdbs']))
     
     start_time = time.time()
     if detail:
-        discard = p.map(get_details,sub_array)    
+        sample = pool_map(get_details,sub_array)    
     else:
-        discard = p.map(get_basic,sub_array)
+        sample = pool_map(get_basic,sub_array)
     end_time = time.time()
     
-    # Cleanup
-    del discard
-    del p
-    
-    est_time = pretty_time((end_time - start_time) * (config['dbcount'] / config['maxdbs']))
+    remaining = config['dbcount'] - len(sample)
+    est_time = pretty_time((end_time - start_time) * (float(remaining) / len(sample)))
     
     # Print a time estimate for details, proceed when ready
-    print " There are {0} databases in the account.".format(count_pretty(config['dbcount']))
-    print " Estimated completion time: {0}\n".format(est_time)
-    ready = raw_input(" Are you sure? (Y/n) ")
-    if ready in ('n','N'):
-        sys.exit(" Aborting.")
+    # (Machine-readable runs don't stop to ask)
+    if config['output'].table:
+        print " There are {0} databases in the account.".format(count_pretty(config['dbcount']))
+        print " Estimated completion time: {0}\n".format(est_time)
+        ready = raw_input(" Are you sure? (Y/n) ")
+        if ready in ('n','N'):
+            sys.exit(" Aborting.")
+    return sample, sub_array[-1]
 
 
-def summary(dbs):
-    totals = np.array([0,0,0,0])
-    totalsline = "|{0:20}|{1:>18} |"
-    width = len(totalsline.format('',''))
-    # Open a multi-process pool with CPU count processes
-    p = Pool()
+def summary(dbs, sample=[]):
+    # dbs yields the databases not already queried for the sample
+    # Single accumulator for doc count, deleted doc count, active size and disk size
+    totals = np.zeros(4, dtype=np.int64)
     
+    # Fold each result in as it arrives, in any order, so nothing is held per database
     start_time = time.time()
-    totals_array = p.map(get_basic,dbs)
+    remaining = pool_results(get_basic, dbs, config['dbcount'] - len(sample), len(sample), ordered=False)
+    for db, thisdb in itertools.chain(sample, remaining):
+        totals += thisdb
+        emit_database(db, dict(zip(('doc_count', 'del_doc_count', 'active', 'disk'), thisdb)))
     end_time = time.time()
     
-    print " HTTP Queries completed in: {0}".format(
-        pretty_time((end_time - start_time))
-    )
-            
-    # Cleanup
-    del p
-            
-    # Sub all totals from array of result arrays
-    # (This would be eliminated as a need if inter-process communication was implemented)
-    for thisdb in totals_array:
-        totals = totals + np.array(thisdb)
-    
+    if config['output'].table:
+        print " HTTP Queries completed in: {0}".format(
+            pretty_time((end_time - start_time))
+        )
+    print_summary(config['dbcount'], totals)
+
+def follow_updates():
+    # Keeps account totals in the local cache up to date from the _db_updates feed, so
+    # only databases created, updated or deleted since the last run are queried
+    cache = config['cache']
+    updates_url = 'https://{0}.cloudant.com/_db_updates'.format(config['account'])
+    since = cache.get_since(config['account'], '_db_updates')
+    start_time = time.time()
+    if since is None:
+        # Note the feed position first, so nothing that changes during the inventory is missed
+        if config['output'].table:
+            print " No saved _db_updates position for {0}, taking a full inventory".format(config['account'])
+        since = http_request(updates_url + '?feed=normal&since=now')['last_seq']
+        cache.clear(config['account'])
+        dbcount = sum(1 for db in iter_all_dbs())
+        for result in pool_results(get_basic, iter_all_dbs(), dbcount, ordered=False):
+            pass
+    else:
+        changed = dict()
+        while True:
+            page = http_request('{0}?feed=normal&limit={1}&since={2}'.format(
+                updates_url,
+                config['updates_batch'],
+                urllib.quote(since)
+            ))
+            for update in page['results']:
+                changed[update['db_name']] = update['type']
+            since = page['last_seq']
+            if len(page['results']) < config['updates_batch']:
+                break
+        updated = []
+        deleted = 0
+        for db, update_type in changed.iteritems():
+            if update_type == 'deleted':
+                cache.delete(config['account'], db)
+                deleted = deleted + 1
+            else:
+                updated.append(db)
+        for result in pool_results(get_basic, updated, len(updated), ordered=False):
+            pass
+        if config['output'].table:
+            print " {0} databases changed since the last run ({1} deleted)".format(
+                count_pretty(len(changed)),
+                count_pretty(deleted)
+            )
+    cache.put_since(config['account'], '_db_updates', since)
+    if config['output'].table:
+        print " Updates processed in: {0}".format(pretty_time(time.time() - start_time))
+
+    totals = cache.totals(config['account'])
+    print_summary(totals[0], totals[1:])
+
+def print_summary(dbcount, totals):
+    # totals is doc count, deleted doc count, active size and disk size
+    emit_account(dbcount, dict(zip(('doc_count', 'del_doc_count', 'active', 'disk'), totals)))
+    if not config['output'].table:
+        return
+    totalsline = "|{0:20}|{1:>18} |"
+    width = len(totalsline.format('',''))
     print '_' * width
     print "|{0:^20}|{1:^18} |".format("Cloudant Account:",config['account'])
     print '-' * width
-    print totalsline.format("Number of databases",config['dbcount'])
+    print totalsline.format("Number of databases",dbcount)
     print totalsline.format("Total docs",count_pretty(totals[0]))
     print totalsline.format("Total deleted docs",count_pretty(totals[1]))
     print totalsline.format("Total active size",data_size_pretty(totals[2]))
     print totalsline.format("Total disk size",data_size_pretty(totals[3]))
     print '-' * width
 
-def get_basic(db):
+def pool_map(func, dbs):
+    # Database requests are pure network I/O, so they run on threads sharing one
+    # connection pool rather than on one process per CPU core
+    if config['pool'] is None:
+        config['pool'] = ThreadPool(config['concurrency'])
+    try:
+        return config['pool'].map(func, dbs)
+    except IOError as e:
+        sys.exit("Failed, bad HTTP response: {0}".format(e))
+
+def iter_all_dbs(after=None):
+    # Yields every database name in the account (or every name after 'after'), fetching
+    # _all_dbs one page at a time
+    myurl = 'https://{0}.cloudant.com/_all_dbs?limit={1}'.format(config['account'], config['page_size'])
+    last_db = after
+    while True:
+        if last_db is None:
+            page = http_request(myurl)
+        else:
+            page = http_request('{0}&skip=1&startkey={1}'.format(
+                myurl,
+                urllib.quote(json.dumps(last_db))
+            ))
+        for db in page:
+            yield db
+        if len(page) < config['page_size']:
+            return
+        last_db = page[-1]
+
+def windowed_imap(func, dbs, ordered):
+    # Pool.imap reads its whole input up front, so at most 'concurrency * 8' databases
+    # are handed to the pool at once, to keep the names and results held in memory
+    # bounded. Another database is handed over each time a result is taken, so the
+    # pool never sits idle waiting for the slowest request of a batch.
+    if config['pool'] is None:
+        config['pool'] = ThreadPool(config['concurrency'])
+    window = config['concurrency'] * 8
+    dbs = iter(dbs)
+    submitted = deque() # Results not yet taken, in database order
+    finished = Queue.Queue() # (ok, result or exception), in completion order
+
+    def run(db):
+        try:
+            finished.put((True, func(db)))
+        except Exception as e:
+            finished.put((False, e))
+
+    outstanding = 0
+    for db in dbs:
+        if ordered:
+            submitted.append(config['pool'].apply_async(func, (db,)))
+        else:
+            config['pool'].apply_async(run, (db,))
+        outstanding = outstanding + 1
+        if outstanding < window:
+            continue
+        outstanding = outstanding - 1
+        yield take_result(submitted, finished, ordered)
+    while outstanding > 0:
+        outstanding = outstanding - 1
+        yield take_result(submitted, finished, ordered)
+
+def take_result(submitted, finished, ordered):
+    # Waits for the next result from windowed_imap's pool, raising any error it hit
+    if ordered:
+        return submitted.popleft().get()
+    ok, result = finished.get()
+    if not ok:
+        raise result
+    return result
+
+def pool_results(func, dbs, total, done=0, ordered=True):
+    # Yields results as they complete (in database order unless ordered is False), keeping
+    # a live throughput and ETA line on the terminal. 'total' is the number of databases
+    # in dbs, and 'done' the number already queried.
+    results = windowed_imap(func, dbs, ordered)
+    show_progress = sys.stderr.isatty()
+    start_time = time.time()
+    last_shown = 0
+    count = 0
+    try:
+        for result in results:
+            count = count + 1
+            now = time.time()
+            if show_progress and (now - last_shown > config['progress_interval'] or count == total):
+                last_shown = now
+                rate = count / max(now - start_time, 0.001)
+                sys.stderr.write("\r {0} of {1} databases, {2}/sec, {3} remaining        ".format(
+                    count_pretty(done + count),
+                    count_pretty(done + total),
+                    count_pretty(int(rate)),
+                    pretty_time(max(total - count, 0) / rate)
+                ))
+            yield result
+    except IOError as e:
+        sys.exit("Failed, bad HTTP response: {0}".format(e))
+    if show_progress and count > 0:
+        sys.stderr.write("\n")
+
+def get_stats(db):
+    # Returns the cache entry for a database, fetching its stats from Cloudant unless
+    # running with --refresh and the cached stats are younger than the TTL
+    entry = config['cache'].get(config['account'], db)
+    if (config['refresh'] and entry is not None and entry['stats_at'] is not None and
+            time.time() - entry['stats_at'] < config['ttl']):
+        with config['lock']:
+            config['cache_hits'] = config['cache_hits'] + 1
+        return entry
     myurl = 'https://{0}.cloudant.com/{1}'.format(config['account'],db)
-    stats = http_request(myurl)
+    stats = fetch_json(myurl)
     # Account for small or empty databases, where the API gets weird on disk space
     if stats['sizes']['active'] == None:
         active = stats['sizes']['external']
     else:
         active = stats['sizes']['active']
-    return [
-        stats['doc_count'],
-        stats['doc_del_count'],
+    config['cache'].put_stats(
+        config['account'],
+        db,
+        int(stats['doc_count']),
+        int(stats['doc_del_count']),
         active,
-        stats['sizes']['file']
+        stats['sizes']['file'],
+        stats.get('update_seq')
+    )
+    return config['cache'].get(config['account'], db)
+
+def get_basic(db):
+    entry = get_stats(db)
+    return db, [
+        entry['doc_count'],
+        entry['del_doc_count'],
+        entry['active'],
+        entry['disk']
     ]
 
 def get_details(db):
-    myurl = 'https://{0}.cloudant.com/{1}'.format(config['account'],db)
-    stats = http_request(myurl)
+    entry = get_stats(db)
 
-    myurl = 'https://{0}.cloudant.com/{1}/_shards'.format(config['account'],db)
-    shards = http_request(myurl)['shards']
-    shardcount = len(shards)
-    
-    nvalue = len(shards.itervalues().next())
-    doc_count = int(stats['doc_count'])
-    del_doc_count = int(stats['doc_del_count'])
-    disk = stats['sizes']['file']
-    
-    # Account for small or empty databases, where the API gets weird on disk space
-    if stats['sizes']['active'] == None:
-        active = stats['sizes']['external']
-    else:
-        active = stats['sizes']['active']
+    # Shard layout never changes, so it's only fetched the first time a database is seen
+    if entry['shardcount'] is None:
+        myurl = 'https://{0}.cloudant.com/{1}/_shards'.format(config['account'],db)
+        shards = fetch_json(myurl)['shards']
+        entry['shardcount'] = len(shards)
+        entry['nvalue'] = len(shards.itervalues().next())
+        config['cache'].put_shards(config['account'], db, entry['shardcount'], entry['nvalue'])
 
     return dict(
         db = db,
-        shardcount = shardcount,
-        nvalue = nvalue,
-        active = active,
-        disk = disk,
-        doc_count = doc_count,
-        del_doc_count = del_doc_count
+        shardcount = entry['shardcount'],
+        nvalue = entry['nvalue'],
+        active = entry['active'],
+        disk = entry['disk'],
+        doc_count = entry['doc_count'],
+        del_doc_count = entry['del_doc_count']
     )
 
 def data_size_pretty(size):
@@ -267,12 +527,19 @@ def count_pretty(count):
     #return "{:,}".format(count)
     
 def http_request(url):
-    r = requests.get(
+    try:
+        return fetch_json(url)
+    except IOError:
+        sys.exit("Failed, bad HTTP response")
+
+def fetch_json(url):
+    # Raises instead of exiting, for use from worker threads
+    r = cloudant_client.get(
         url,
         headers = config['my_header']
     )
     if r.status_code not in (200,201,202):
-        sys.exit("Failed, bad HTTP response")
+        raise IOError("HTTP {0} from {1}".format(r.status_code, url))
     return r.json()
 
 if __name__ == "__main__":